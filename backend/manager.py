@@ -4,72 +4,140 @@ The central hub for administrating the application.
 
 ### System ###
 import logging
-
-### Magenta ###
-from magenta.models.drums_rnn import drums_rnn_sequence_generator
-from magenta.models.melody_rnn import melody_rnn_sequence_generator
-from magenta.models.polyphony_rnn import polyphony_sequence_generator
-from magenta.models.performance_rnn import performance_sequence_generator
-from magenta.models.pianoroll_rnn_nade import pianoroll_rnn_nade_sequence_generator
-from magenta.music.sequence_generator_bundle import read_bundle_file, GeneratorBundleParseException
+from time import time
+from threading import Lock, Thread
+from importlib import import_module
+from concurrent.futures import ThreadPoolExecutor
 
 ### Local ###
 from settings import *  # pylint: disable-msg=wildcard-import, unused-wildcard-import
 from .song import Song, SongPart, load_song
 from middleware.virtual_keyboard import Keyboard
-from middleware import MidiHarmonizer, MidiRecorder
-from midi_interface import SongStructureMidiInteraction
+from middleware import MidiHarmonizer, MidiRecorder, MiddlewarePipeline
+from midi_interface import GeneratorService, SongStructureMidiInteraction
+from midi_interface.instrumentation import enable_instrumentation, get_instrumentation
+from midi_interface.sequence_cache import SequenceCache
 
 ### Globals ###
-GENERATOR_MAP = melody_rnn_sequence_generator.get_generator_map()
-GENERATOR_MAP.update(drums_rnn_sequence_generator.get_generator_map())
-GENERATOR_MAP.update(performance_sequence_generator.get_generator_map())
-GENERATOR_MAP.update(pianoroll_rnn_nade_sequence_generator.get_generator_map())
-GENERATOR_MAP.update(polyphony_sequence_generator.get_generator_map())
+_MELODY_RNN = "magenta.models.melody_rnn.melody_rnn_sequence_generator"
+_DRUMS_RNN = "magenta.models.drums_rnn.drums_rnn_sequence_generator"
+_PERFORMANCE_RNN = "magenta.models.performance_rnn.performance_sequence_generator"
+_PIANOROLL_RNN_NADE = "magenta.models.pianoroll_rnn_nade.pianoroll_rnn_nade_sequence_generator"
+_POLYPHONY_RNN = "magenta.models.polyphony_rnn.polyphony_sequence_generator"
+
+# Modules providing the SequenceGenerator() for each known generator id.
+# They are only imported once a bundle with one of their ids is loaded.
+GENERATOR_MODULES = {
+    "basic_rnn": _MELODY_RNN,
+    "mono_rnn": _MELODY_RNN,
+    "lookback_rnn": _MELODY_RNN,
+    "attention_rnn": _MELODY_RNN,
+    "drum_kit": _DRUMS_RNN,
+    "performance": _PERFORMANCE_RNN,
+    "performance_with_dynamics": _PERFORMANCE_RNN,
+    "rnn-nade": _PIANOROLL_RNN_NADE,
+    "rnn-nade_attn": _PIANOROLL_RNN_NADE,
+    "polyphony": _POLYPHONY_RNN,
+}
+
+# SequenceGenerator() classes keyed by generator id, filled as their modules are imported.
+GENERATOR_MAP = {}
+_GENERATOR_MAP_LOCK = Lock()
+
+
+def get_generator_class(generator_id):
+    """Returns the SequenceGenerator() class for a generator id, importing only the module that provides it."""
+    with _GENERATOR_MAP_LOCK:
+        if generator_id not in GENERATOR_MAP:
+            if generator_id in GENERATOR_MODULES:
+                module_names = [GENERATOR_MODULES[generator_id]]
+            else:
+                # Unknown ids might still be provided by one of the modules, e.g. in newer Magenta versions.
+                module_names = sorted(set(GENERATOR_MODULES.values()))
+            for module_name in module_names:
+                GENERATOR_MAP.update(import_module(module_name).get_generator_map())
+                if generator_id in GENERATOR_MAP:
+                    break
+        return GENERATOR_MAP.get(generator_id)
 
 
 def load_generator_from_bundle_file(bundle_file):
     """loads a bundle file as a SequenceGenerator() object."""
+    # pylint: disable-msg=no-member
+    started = time()
+    # Imported here, as magenta.music imports TensorFlow, which is only needed once models are loaded.
+    from magenta.music.sequence_generator_bundle import read_bundle_file, GeneratorBundleParseException
     try:
         bundle = read_bundle_file(bundle_file)
     except GeneratorBundleParseException:
         logging.warning("Failed to parse '{}'".format(bundle_file))
         return None
+    read_time = time()
 
-    generator_id = bundle.generator_details.id  # pylint: disable-msg=no-member
-    if generator_id not in GENERATOR_MAP:
+    generator_id = bundle.generator_details.id
+    generator_class = get_generator_class(generator_id)
+    if not generator_class:
         logging.warning("Unrecognized SequenceGenerator ID '{}' in '{}'".format(generator_id, bundle_file))
         return None
+    import_time = time()
 
-    generator = GENERATOR_MAP[generator_id](checkpoint=None, bundle=bundle)
+    generator = generator_class(checkpoint=None, bundle=bundle)
+    build_time = time()
     generator.initialize()
-    logging.info("Loaded '{}' generator bundle from file '{}'".format(
-        bundle.generator_details.id, bundle_file))  # pylint: disable-msg=no-member
+    initialize_time = time()
+    logging.info("Loaded '{}' generator bundle from file '{}' in {:.3f}s "
+                 "(read: {:.3f}s, import: {:.3f}s, build: {:.3f}s, initialize: {:.3f}s)".format(
+                     generator_id, bundle_file, initialize_time - started, read_time - started,
+                     import_time - read_time, build_time - import_time, initialize_time - build_time))
     return generator
 
 
 class ComposerManager():
 
-    def __init__(self):
+    def __init__(self, concurrent_generation=CONCURRENT_GENERATION):
         self.generators = []
+        self.generator_service = None
+        self._models_loader = None
+        # The exception that stopped the models from loading, raised again by wait_for_models().
+        self._models_error = None
+        self.concurrent_generation = concurrent_generation
+        self.sequence_cache = SequenceCache(SEQUENCE_CACHE_DIR, SEQUENCE_CACHE_SIZE)
         self.interaction = None
+        # The in-process pipeline that the interaction plays into, with the harmonizer and recorder as stages.
+        self.middleware = None
         self.harmonizer = None
         self.recorder = None
         self.input_port = None
         self.output_port = None
         self.selected_song = None
+        self.harmonization_mode = HARMONIZATION_MODE
         self.keyboard_melody = Keyboard(channel=1, note_shift=-36)
         self.keyboard_bass = Keyboard(channel=2, note_shift=-12)
+        if MIDI_INSTRUMENTATION:
+            enable_instrumentation()
 
     def set_song(self, song):
         logging.info("Song set to '{}'".format(song))
         self.selected_song = song
+        if self.harmonizer:
+            self.harmonizer.set_mode(self.harmonization_mode, self._song_key())
+
+    def _song_key(self):
+        return self.selected_song.key if self.selected_song else "C"
 
-    def note_callback(self, original_msg, new_msg):
-        """An internal callback for displaying the currently active notes on a Keyboard() object."""
-        # pylint: disable-msg=unused-argument
-        self.keyboard_melody.handle_message(new_msg)
-        self.keyboard_bass.handle_message(new_msg)
+    def set_harmonization_mode(self, mode):
+        """Selects how the harmonizer fits notes to the chords, takes effect immediately while playing."""
+        logging.info("Harmonization mode set to '{}'".format(mode))
+        self.harmonization_mode = mode
+        if self.harmonizer:
+            self.harmonizer.set_mode(mode, self._song_key())
+
+    def set_concurrent_generation(self, enabled):
+        """Selects whether the generators of a song part run in parallel or one after another."""
+        logging.info("Concurrent generation {}".format("enabled" if enabled else "disabled"))
+        self.concurrent_generation = enabled
+        if self.generator_service:
+            self.generator_service.set_concurrent(enabled)
 
     def set_input_port(self, port):
         logging.info("Input port set to '{}'".format(port))
@@ -80,30 +148,88 @@ class ComposerManager():
         self.output_port = port
 
     def load_models(self):
-        """Loads all required models files into a list of SequenceGenerator() objects"""
-        for bundle_file in ["models/melody.mag", "models/bass.mag", "models/drums.mag"]:
-            generator = load_generator_from_bundle_file(bundle_file)
-            if generator:
-                self.generators.append(generator)
+        """
+        Starts loading all required model files into a list of SequenceGenerator() objects.
+        The bundles are initialized in parallel in the background, then served warm by a GeneratorService().
+        wait_for_models() blocks until they are ready.
+        """
+        if self._models_loader is None:
+            self._models_loader = Thread(target=self._load_models, daemon=True)
+            self._models_loader.start()
+
+    def _load_models(self):
+        started = time()
+        try:
+            with ThreadPoolExecutor(max_workers=len(MODEL_BUNDLES)) as executor:
+                generators = [generator for generator in executor.map(load_generator_from_bundle_file,
+                                                                      MODEL_BUNDLES)
+                              if generator]
+            logging.info("Loaded {} generator bundles in {:.3f}s".format(len(generators), time() - started))
+            self.generators = generators
+            self.generator_service = GeneratorService(generators, concurrent=self.concurrent_generation,
+                                                      cache=self.sequence_cache)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.exception("Failed to load models")
+            self._models_error = e
+            return
+        try:
+            self.generator_service.warm_up()
+        except Exception:  # pylint: disable-msg=broad-except
+            logging.exception("Failed to warm up generators")
+
+    def models_loaded(self):
+        """
+        Returns whether loading the models has finished, successfully or not, without blocking.
+        Starts loading them if that has not been started. A failure is raised by start() and wait_for_models().
+        """
+        self.load_models()
+        return not self._models_loader.is_alive()
+
+    def wait_for_models(self):
+        """
+        Blocks until the models are loaded and warmed up, loading them first if that has not been started.
+        Raises the exception that stopped the models from loading, if any.
+        """
+        self.load_models()
+        self._models_loader.join()
+        if self._models_error is not None:
+            raise self._models_error
 
     def start(self):
-        """Sets up the signal chain and starts the generation process."""
-        self.start_harmonizer()
-        self.start_recorder()
+        """
+        Sets up the signal chain and starts the generation process.
+        Returns the number of seconds until the song has been played, including the bar before the first part.
+        """
+        self.wait_for_models()
+        self.start_middleware()
         self.start_interaction(self.selected_song)
-        return self.selected_song.duration() * 1.2 # to compensate for generation lag
+        return self.interaction.duration
 
     def stop(self):
         """Stops the signal chain and thus the generation process."""
         self.stop_interaction()
-        self.stop_harmonizer()
-        self.stop_recorder()
+        self.stop_middleware()
+        self.report_instrumentation()
+
+    def report_instrumentation(self):
+        """Writes the MIDI dispatch timings to the log and the instrumentation file, if instrumentation is enabled."""
+        instrumentation = get_instrumentation()
+        if instrumentation is None:
+            return
+        instrumentation.log()
+        if MIDI_INSTRUMENTATION_FILE:
+            try:
+                instrumentation.dump(MIDI_INSTRUMENTATION_FILE)
+            except OSError:
+                logging.exception("Failed to write MIDI instrumentation to '{}'".format(MIDI_INSTRUMENTATION_FILE))
 
     def start_interaction(self, song):
         """Initialises an interaction or starts it if it already exists and has not been stopped."""
         if not self.interaction:
             self.interaction = SongStructureMidiInteraction(self.generators, 120,
-                                                            tick_duration=4 * (60.0 / 120), structure=song)
+                                                            tick_duration=4 * (60.0 / 120), structure=song,
+                                                            generator_service=self.generator_service,
+                                                            output_port=self.middleware.port)
         if self.interaction and not self.interaction.stopped() and not self.interaction.is_alive():
             logging.info("Started MIDI interaction")
             self.interaction.start()
@@ -114,43 +240,38 @@ class ComposerManager():
             logging.debug("Stopping MIDI interaction")
             self.interaction.stop()
             self.interaction.join()
-            self.interaction = None
             logging.info("Stopped MIDI interaction")
+        # An interaction that has played its song to the end is dropped as well, it has already closed its hub.
+        self.interaction = None
 
-    def start_recorder(self):
-        """Initialises a recorder or starts it if it already exists and has not been stopped."""
-        if not self.recorder:
-            self.recorder = MidiRecorder(
-                HARMONIZER_OUTPUT_NAME, self.output_port if self.output_port else RECORDER_OUTPUT_NAME)
-        if self.recorder and not self.recorder.stopped() and not self.recorder.is_alive():
-            logging.info("Started MIDI recorder")
-            self.recorder.start()
-
-    def stop_recorder(self):
-        """Stops a recorder if it exists and deletes the object since Threads can not be restarted."""
-        if self.recorder and self.recorder.is_alive():
-            logging.debug("Stopping MIDI recorder")
-            self.recorder.stop()
-            self.recorder.join()
-            self.recorder = None
-            logging.info("Stopped MIDI recorder")
-
-    def start_harmonizer(self):
-        """Initialises a harmonizer or starts it if it already exists and has not been stopped."""
-        if not self.harmonizer:
-            self.harmonizer = MidiHarmonizer(HARMONIZER_INPUT_NAME, HARMONIZER_OUTPUT_NAME, callback=self.note_callback)
-        if self.harmonizer and not self.harmonizer.stopped() and not self.harmonizer.is_alive():
-            logging.info("Started MIDI harmonizer")
-            self.harmonizer.start()
-
-    def stop_harmonizer(self):
-        """Stops a harmonizer if it exists and deletes the object since Threads can not be restarted."""
-        if self.harmonizer and self.harmonizer.is_alive():
-            logging.debug("Stopping MIDI harmonizer")
-            self.harmonizer.stop()
-            self.harmonizer.join()
+    def start_middleware(self):
+        """
+        Initialises the middleware pipeline of harmonizer, recorder and keyboard displays,
+        or starts it if it already exists and has not been stopped.
+        """
+        if not self.middleware:
+            self.harmonizer = MidiHarmonizer(None, None, mode=self.harmonization_mode, key=self._song_key())
+            self.recorder = MidiRecorder(None, None, path=RECORDING_FILE, flush_interval=RECORDING_FLUSH_INTERVAL)
+            self.middleware = MiddlewarePipeline(
+                [self.harmonizer, self.recorder, self.keyboard_melody, self.keyboard_bass],
+                self.output_port if self.output_port else RECORDER_OUTPUT_NAME)
+        if self.middleware and not self.middleware.stopped() and not self.middleware.is_alive():
+            logging.info("Started MIDI middleware")
+            self.middleware.start()
+
+    def stop_middleware(self):
+        """Stops the middleware pipeline if it exists and deletes it, since its stages can not be restarted."""
+        if self.middleware and self.middleware.is_alive():
+            logging.debug("Stopping MIDI middleware")
+            self.middleware.stop()
+            self.middleware.join()
+            logging.info("Stopped MIDI middleware | stages: {}".format(" | ".join(
+                "{}: {} messages, mean {:.1f}us, max {:.1f}us".format(
+                    name, stats["count"], (stats["mean"] or 0) * 1e6, stats["max"] * 1e6)
+                for name, stats in self.middleware.stats().items())))
+            self.middleware = None
             self.harmonizer = None
-            logging.info("Stopped MIDI harmonizer")
+            self.recorder = None
 
     def reset(self):
         """Alias for stop()."""
@@ -0,0 +1,158 @@
+"""
+Offline rendering of songs straight into MIDI files, without waiting for real-time playback.
+"""
+
+### System ###
+import zlib
+import logging
+from time import time
+from bisect import bisect_right
+
+### Mido ###
+from mido import MidiFile, MidiTrack, Message, MetaMessage  # pylint: disable-msg=no-name-in-module
+from mido.midifiles.units import second2tick, bpm2tempo
+
+### Local ###
+from middleware.harmonizer import harmonization, DEFAULT_HARMONIZATION_MODE
+from middleware.recorder import CHANNEL_PROGRAMS
+from midi_interface import PartGenerator, protobuf
+
+MELODY_CHANNEL = 1
+BASS_CHANNEL = 2
+CHORD_CHANNEL = 3
+DRUM_CHANNEL = 9
+
+_TICKS_PER_BEAT = 480
+_CHORD_VELOCITY = 80
+
+
+def _primer(bpm, duration):
+    """Returns an empty primer of the given duration, like the one a live interaction captures."""
+    # pylint: disable-msg=no-member
+    primer = protobuf.NoteSequence()
+    primer.tempos.add(qpm=bpm)
+    primer.total_time = duration
+    return primer
+
+
+def _part_seed(seed, index):
+    """Derives the seed of the part at 'index' from the seed of its song."""
+    return zlib.crc32("{}:{}".format(seed, index).encode("utf-8"))
+
+
+def generate_parts(song, part_generator, bpm=120, temperature=1.0, variation=0, seed=None):
+    """
+    Generates every distinct part of a song once.
+    Returns their CacheItem()s and the time it took to generate them, both keyed by part name.
+    Different variations of a song are cached separately.
+    If 'seed' is given, every part is sampled with a seed of its own, so the song does not depend on which
+    parts were cached.
+    """
+    bar_duration = 4 * 60.0 / bpm
+    song_digest = song.digest() if not variation else "{}/{}".format(song.digest(), variation)
+    for index, part in enumerate(song):
+        # Every part is primed with a silent bar, just like the first part of a live interaction.
+        part_generator.submit(part, _primer(bpm, bar_duration), 0, bar_duration,
+                              bar_duration + part.duration(bars=True) * bar_duration, temperature,
+                              song_digest=song_digest, seed=None if seed is None else _part_seed(seed, index))
+    items, latencies = {}, {}
+    for part in song:
+        if part.name not in items:
+            items[part.name], latencies[part.name] = part_generator.timed_result(part.name)
+    return items, latencies
+
+
+def arrange_song(song, items, bpm=120, harmonization_mode=DEFAULT_HARMONIZATION_MODE):
+    """
+    Places the generated parts of a song one after another and harmonizes the melody and bass
+    with the chords, in the same way the MidiHarmonizer() does during playback in 'harmonization_mode'.
+    Returns lists of (start, end, pitch, velocity) tuples keyed by MIDI channel.
+    """
+    bar_duration = 4 * 60.0 / bpm
+    quarter_duration = 60.0 / bpm
+    notes = {MELODY_CHANNEL: [], BASS_CHANNEL: [], CHORD_CHANNEL: [], DRUM_CHANNEL: []}
+    chord_times, chords = [], []
+
+    position = 0
+    for part in song:
+        for i, chord in enumerate(song.chord_table(part)):
+            chord = chord[chord >= 0].tolist()
+            start = position + i * quarter_duration
+            chord_times.append(start)
+            chords.append((start + quarter_duration, chord))
+            notes[CHORD_CHANNEL].extend((start, start + quarter_duration, pitch, _CHORD_VELOCITY) for pitch in chord)
+
+        melody_item, bass_item, drum_item = items[part.name]
+        for channel, item in [(MELODY_CHANNEL, melody_item), (BASS_CHANNEL, bass_item), (DRUM_CHANNEL, drum_item)]:
+            part_notes = item.notes_at(position)
+            notes[channel].extend(zip(part_notes.start_times.tolist(), part_notes.end_times.tolist(),
+                                      part_notes.pitches.tolist(), part_notes.velocities.tolist()))
+        position += part.duration(bars=True) * bar_duration
+
+    def chord_at(time_):
+        index = bisect_right(chord_times, time_) - 1
+        if index < 0 or chords[index][0] <= time_:
+            return []
+        return chords[index][1]
+
+    strategy = harmonization(harmonization_mode, song.key)
+    for channel in [MELODY_CHANNEL, BASS_CHANNEL]:
+        harmonized = []
+        for start, end, pitch, velocity in notes[channel]:
+            table = strategy.table(chord_at(start))
+            if table is not None:
+                pitch = table[pitch]
+            # Shift bass notes to correct pitch
+            if channel == BASS_CHANNEL:
+                pitch -= 12
+            harmonized.append((start, end, pitch, velocity))
+        notes[channel] = harmonized
+
+    return notes
+
+
+def write_midi_file(notes, path, bpm=120):
+    """Writes the notes of every channel into a track of its own, in the layout the MidiRecorder() uses."""
+    tempo = bpm2tempo(bpm)
+    midi_file = MidiFile(ticks_per_beat=_TICKS_PER_BEAT)
+    for channel in [DRUM_CHANNEL, MELODY_CHANNEL, BASS_CHANNEL, CHORD_CHANNEL]:
+        events = []
+        if channel in CHANNEL_PROGRAMS:
+            events.append((0, 0, Message(type="program_change", program=CHANNEL_PROGRAMS[channel], channel=channel)))
+        for start, end, pitch, velocity in notes[channel]:
+            start_tick = int(round(second2tick(start, _TICKS_PER_BEAT, tempo)))
+            end_tick = int(round(second2tick(end, _TICKS_PER_BEAT, tempo)))
+            events.append((start_tick, 2, Message(type="note_on", note=pitch, velocity=velocity, channel=channel)))
+            events.append((end_tick, 1, Message(type="note_off", note=pitch, channel=channel)))
+        # Sort note offs before note ons at the same tick, so that repeated notes are not cut short.
+        events.sort(key=lambda event: event[:2])
+
+        track = MidiTrack()
+        if not midi_file.tracks:
+            track.append(MetaMessage("set_tempo", tempo=tempo))
+        last_tick = 0
+        for tick, _, msg in events:
+            track.append(msg.copy(time=tick - last_tick))
+            last_tick = tick
+        midi_file.tracks.append(track)
+    midi_file.save(path)
+
+
+def render_song(song, service, path, bpm=120, temperature=1.0, variation=0,
+                harmonization_mode=DEFAULT_HARMONIZATION_MODE, seed=None):
+    """
+    Generates a full song part by part through a GeneratorService(), without any wall-clock ticks,
+    and writes it to a MIDI file.
+    Returns the time in seconds it took to generate each distinct part, keyed by part name.
+    """
+    started = time()
+    part_generator = PartGenerator(service)
+    try:
+        items, latencies = generate_parts(song, part_generator, bpm, temperature, variation, seed)
+    finally:
+        part_generator.cancel()
+    write_midi_file(arrange_song(song, items, bpm, harmonization_mode), path, bpm)
+    elapsed = time() - started
+    logging.info("Rendered '{}' to '{}' in {:.1f}s ({:.1f}x real time)".format(
+        song.name, path, elapsed, song.duration(bpm=bpm) / max(elapsed, 1e-6)))
+    return latencies
@@ -4,10 +4,14 @@ Classes representing a song on a high level.
 
 ### System ###
 import os
+import hashlib
 import logging
 from math import ceil
 from itertools import chain
 
+### Numpy ###
+import numpy as np
+
 ### Local ###
 from mingus.containers import NoteContainer
 from mingus.core.progressions import to_chords
@@ -28,6 +32,7 @@ def load_song(path):
                         structure.author = data[1].strip()
                     if len(data) > 2:
                         main_key = data[2].strip()
+                structure.key = main_key
                 continue
             parts = [l.strip() for l in line.split(",")]
             split_data = [tuple(part.split(":")) for part in parts[1:]]
@@ -44,6 +49,7 @@ def load_song(path):
                 song_part = chords_per_part[song_part.name]
             structure.append(song_part)
             chords_per_part[song_part.name] = song_part
+    structure.compile()
     logging.info("Loaded '{}' with structure: {}".format(os.path.basename(path), structure))
     return structure
 
@@ -75,6 +81,18 @@ class SongPart(list):
             note_list.append([[int(note) + shift for note in NoteContainer(chord)] for chord in chords])
         return list(chain.from_iterable(note_list))
 
+    def compile(self, shift=0):
+        """
+        Resolves the chord progression into a read-only array of MIDI pitches,
+        with one row per quarter and one column per voice. Unused voices are set to -1.
+        """
+        chords = self.get_midi_chords(shift)
+        table = np.full((len(chords), max((len(chord) for chord in chords), default=0)), -1, dtype=np.int8)
+        for i, chord in enumerate(chords):
+            table[i, :len(chord)] = chord
+        table.flags.writeable = False
+        return table
+
     def __repr__(self):
         return "SongPart(name='{}', chords={})".format(self.name, super(SongPart, self).__repr__())
 
@@ -82,16 +100,36 @@ class SongPart(list):
 class Song(list):
     """A container for a list of SongPart()s, which forms a full song."""
 
-    def __init__(self, name=None, author=None, parts=None):
+    def __init__(self, name=None, author=None, parts=None, key="C"):
         if not parts:
             parts = []
         self.name = name
         self.author = author
+        # The main key of the song, in which minor keys are written in lower case.
+        self.key = key
+        # Compiled chord tables keyed by part name and chords, shared by all parts with the same progression.
+        self.chord_tables = {}
         super(Song, self).__init__(parts)
 
     def duration(self, bars=False, bpm=120):
         """Returns the summed duration of all SongPart()s contained within it."""
         return sum((part.duration(bars, bpm) for part in self))
 
+    def compile(self):
+        """Compiles the chord table of every distinct part ahead of playback."""
+        for part in self:
+            self.chord_table(part)
+
+    def chord_table(self, part):
+        """Returns the compiled chord table of a part, see SongPart.compile()."""
+        key = (part.name, tuple(tuple(chord) for chord in part))
+        if key not in self.chord_tables:
+            self.chord_tables[key] = part.compile()
+        return self.chord_tables[key]
+
+    def digest(self):
+        """Returns a hash of the name, author and structure of the song that identifies its content."""
+        return hashlib.sha1(repr(self).encode("utf-8")).hexdigest()
+
     def __repr__(self):
         return "Song(name='{}', author='{}', parts={})".format(self.name, self.author, super(Song, self).__repr__())
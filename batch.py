@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Headless entry-point for rendering variations of many songs in parallel.
+"""
+
+### Logging ###
+import logging
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s")
+
+### System ###
+import os
+import sys
+import zlib
+import argparse
+from glob import glob
+from math import ceil
+from time import time
+from signal import signal, SIGINT, SIG_IGN
+from multiprocessing import cpu_count, Pool
+
+### Local ###
+from settings import MODEL_BUNDLES, SEQUENCE_CACHE_DIR, SEQUENCE_CACHE_SIZE
+from backend.song import load_song
+from backend.renderer import render_song
+from backend.manager import load_generator_from_bundle_file
+from midi_interface import GeneratorService
+from midi_interface.sequence_cache import SequenceCache
+
+# Generator service of a worker process, set up once when the worker starts.
+worker_service = None
+# The reason the worker failed to set up, raised by render() so that the batch stops.
+# An initializer that raises would only get the worker restarted by the pool, over and over again.
+worker_error = None
+
+
+def init_worker(bundle_files, use_cache):
+    """Loads the model bundles once per worker process and warms them up."""
+    global worker_service, worker_error
+    signal(SIGINT, SIG_IGN)
+    try:
+        generators = [load_generator_from_bundle_file(bundle_file) for bundle_file in bundle_files]
+        failed = [bundle_file for bundle_file, generator in zip(bundle_files, generators) if generator is None]
+        if failed:
+            raise RuntimeError("Failed to load model bundles: {}".format(", ".join(failed)))
+        cache = SequenceCache(SEQUENCE_CACHE_DIR, SEQUENCE_CACHE_SIZE) if use_cache else None
+        worker_service = GeneratorService(generators, cache=cache)
+        worker_service.warm_up()
+    except Exception as e:  # pylint: disable-msg=broad-except
+        logging.exception("Failed to set up worker")
+        worker_error = "{}: {}".format(e.__class__.__name__, e)
+
+
+def render(task):
+    """Renders one variation of a song and returns the generation times of its parts."""
+    if worker_error is not None:
+        raise RuntimeError(worker_error)
+    song_file, variation, output_dir = task
+    # Seed the sampling of every variation individually, so that variations differ but are reproducible.
+    seed = zlib.crc32("{}:{}".format(os.path.basename(song_file), variation).encode("utf-8"))
+
+    song = load_song(song_file)
+    name = os.path.splitext(os.path.basename(song_file))[0]
+    path = os.path.join(output_dir, "{}_{}.mid".format(name, variation + 1))
+    latencies = render_song(song, worker_service, path, variation=variation, seed=seed)
+    return path, list(latencies.values())
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    return values[max(0, int(ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def main(args):
+    files = sorted(glob(os.path.join(args.input_dir, "*.sng")))
+    if not files:
+        print("No .sng files found in '{}'".format(args.input_dir))
+        sys.exit(1)
+    missing = [bundle_file for bundle_file in MODEL_BUNDLES if not os.path.isfile(bundle_file)]
+    if missing:
+        print("Model bundles not found: {}".format(", ".join(missing)))
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    tasks = [(song_file, variation, args.output_dir) for song_file in files for variation in range(args.variations)]
+
+    original_sigint_handler = signal(SIGINT, SIG_IGN)
+    worker_pool = Pool(args.num_processes, initializer=init_worker, initargs=(MODEL_BUNDLES, not args.no_cache))
+    signal(SIGINT, original_sigint_handler)
+
+    started = time()
+    rendered, latencies = 0, []
+    try:
+        for path, part_latencies in worker_pool.imap_unordered(render, tasks):
+            rendered += 1
+            latencies.extend(part_latencies)
+            print("[{}/{}] {}".format(rendered, len(tasks), path))
+    except KeyboardInterrupt:
+        print("\nReceived SIGINT, terminating...")
+        worker_pool.terminate()
+    except RuntimeError as e:
+        print("Batch failed: {}".format(e))
+        worker_pool.terminate()
+        worker_pool.join()
+        sys.exit(1)
+    else:
+        worker_pool.close()
+    worker_pool.join()
+
+    elapsed = time() - started
+    print("Rendered {} songs in {:.1f}s ({:.2f} songs/min)".format(rendered, elapsed, rendered / elapsed * 60))
+    if latencies:
+        print("Part latency: p50 {:.3f}s | p90 {:.3f}s | p99 {:.3f}s | max {:.3f}s".format(
+            percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), max(latencies)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, dest="input_dir", required=True,
+                        metavar="dir", help="(required) The directory containing the .sng files")
+    parser.add_argument("-o", "--output", type=str, dest="output_dir", required=True,
+                        metavar="dir", help="(required) The directory to write the MIDI files to")
+    parser.add_argument("-n", "--variations", type=int, dest="variations", default=1,
+                        metavar="N", help="The amount of variations to generate per song (default: 1)")
+    parser.add_argument("-p", "--processes", type=int, dest="num_processes", default=cpu_count(),
+                        metavar="N", help="The amount of worker processes to use (default: {})".format(cpu_count()))
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        help="Always run inference instead of reusing cached part sequences")
+    main(parser.parse_args())
@@ -10,16 +10,21 @@ logging.basicConfig(filename="output.log",
                     format="%(asctime)s - %(levelname)s - %(message)s")
 
 ### System ###
+from time import time
 from signal import signal, SIGINT
 
 ### Local ###
-from ui import TerminalGUI
+_import_started = time()
+from ui import TerminalGUI  # pylint: disable-msg=wrong-import-position
+logging.info("Imported application modules in {:.3f}s".format(time() - _import_started))
 
 
 def main():
     """Entry-point of the application"""
     global app
+    started = time()
     app = TerminalGUI()
+    logging.info("Set up UI in {:.3f}s, models are loading in the background".format(time() - started))
     app.main()
 
 
@@ -1,3 +1,4 @@
 from .virtual_keyboard import MidiPiano
 from .harmonizer import MidiHarmonizer
-from .recorder import MidiRecorder
+from .recorder import MidiRecorder, recover_recording
+from .pipeline import MiddlewarePipeline
@@ -1,121 +1,182 @@
 ### System ###
-from time import sleep
-from threading import Thread, Event
+from functools import lru_cache
+from threading import Lock
 from sortedcontainers import SortedSet
 
-### Mido ###
-from mido import open_input, open_output, get_input_names, get_output_names  # pylint: disable-msg=no-name-in-module
-
 ### Local ###
-from .midi_meta import MidiState, major_notes
+from mingus.core import scales
+from mingus.core.notes import note_to_int
+from .midi_meta import MidiState, major_scale, black_key_map
+from .port_proxy import MidiPortProxy
+
+# The modes of the diatonic scale, which harmonize to the mode of the song's key.
+MODAL_HARMONIZATION_MODES = ["ionian", "dorian", "phrygian", "lydian", "mixolydian", "aeolian", "locrian"]
+HARMONIZATION_MODES = ["major", "chord", "key", "minor"] + MODAL_HARMONIZATION_MODES + ["white_keys"]
+DEFAULT_HARMONIZATION_MODE = "major"
 
 
-class MidiHarmonizer(Thread):
+def chord_shape(chord):
     """
-    Relays MIDI messages by proxying a MIDI connection between virtual or hardware ports.
-    Applies a harmonization algorithm to MIDI messages on specific channels.
+    Normalizes a chord, which is a list of MIDI pitches, to the octave of its lowest note.
+    Chords with the same shape are harmonized the same way.
     """
+    offset = 12 * (min(chord) // 12)
+    return tuple(sorted(set(pitch - offset for pitch in chord)))
+
+
+@lru_cache(maxsize=1024)
+def _shape_table(shape, scale):
+    # TODO: this currently maps to black AND white keys, MelodicFlow maps only to white keys.
+    # This extends the range on the keyboard, but this solution should be more easily compatible
+    # with generated output, as we don't have to transpose the black keys.
+    middle_octave_chords = 4
+    middle_octave_melody = 8
+
+    # Root C note of all octaves
+    octaves = list(range(0, 127, 12))
+
+    # generate tranposed chords and scales for every octave
+    mapped_over_range = [[e + octave for e in shape] for octave in octaves]
+    scale_over_range = [[e + octave for e in scale] for octave in octaves]
+
+    # get valid notes, split for positive and negative movement
+    f_a = SortedSet([e for l in mapped_over_range[:middle_octave_chords] for e in l])
+    f_a.update([e for l in scale_over_range[:middle_octave_chords] for e in l])
+    f_b = SortedSet([e for l in mapped_over_range[middle_octave_chords:] for e in l])
+    f_b.update([e for l in scale_over_range[middle_octave_chords:] for e in l])
+
+    table = []
+    for note in range(128):
+        # If the input note is too low, transpose it upwards
+        # to apply the harmonisation.
+        while note < (middle_octave_melody * 12):
+            note += 12
+
+        # get relative distance from played key to middle C of melody
+        diff = note - octaves[middle_octave_melody]
+        # clamp to valid note range
+        diff = max(-len(f_a), min(diff, len(f_b) - 1))
+
+        # jump to next valid note, either up or down
+        if diff < 0:
+            note = f_a[len(f_a) + diff]
+        else:
+            note = f_b[diff]
 
-    def __init__(self, port_in_name, port_out_name, melody_channel=1, bass_channel=2, chord_channel=3, callback=None):
-        super(MidiHarmonizer, self).__init__()
-        self.port_in_name = port_in_name
-        self.port_in = None
-        self.port_out_name = port_out_name
-        self.port_out = None
-        self.melody_channel = melody_channel
-        self.bass_channel = bass_channel
-        self.chord_channel = chord_channel
-        self.callback = callback
-        self.midi_state = MidiState()
-        self._stop_event = Event()
+        # clamp note to valid MIDI note range
+        table.append(max(0, min(note, 127)))
+    return tuple(table)
 
-    def stop(self):
-        self._stop_event.set()
 
-    def stopped(self):
-        return self._stop_event.is_set()
+class Harmonization():
+    """
+    A strategy for harmonizing notes, which moves them onto the closest valid note.
+    The valid notes are the tones of the current chord, if 'chord_tones' is set, and the notes of 'scale',
+    which is a list of pitch classes.
+    """
 
-    def shutdown(self):
-        self.port_in.close()
-        self.port_out.close()
+    def __init__(self, name, scale=(), chord_tones=True):
+        self.name = name
+        self.scale = tuple(sorted(set(pitch % 12 for pitch in scale)))
+        self.chord_tones = chord_tones
 
-    def run(self):
-        if self.port_in_name in get_input_names():
-            self.port_in = open_input(self.port_in_name, virtual=False)
-        else:
-            self.port_in = open_input(self.port_in_name, virtual=True)
+    def table(self, chord):
+        """
+        Returns a table that maps each of the 128 MIDI pitches onto the closest valid note for the given chord,
+        which is a list of MIDI pitches. Returns None if there is nothing to harmonize to.
+        Tables are computed once per chord shape and cached.
+        """
+        if not self.chord_tones:
+            return _shape_table((), self.scale)
+        if not chord:
+            return None
+        return _shape_table(chord_shape(chord), self.scale)
 
-        if self.port_out_name in get_output_names():
-            self.port_out = open_output(self.port_out_name, virtual=False)
-        else:
-            self.port_out = open_output(self.port_out_name, virtual=True)
+    def __repr__(self):
+        return "Harmonization(name='{}', scale={}, chord_tones={})".format(self.name, self.scale, self.chord_tones)
+
+
+def _scale_pitches(scale):
+    return [note_to_int(note) for note in scale.ascending()]
+
+
+def _tonic(key):
+    """Returns the tonic of a key, in which minor keys are written in lower case."""
+    return key[0].upper() + key[1:]
 
-        # Set the callback and go live
-        self.port_in.callback = self.handle_message
 
-        # Enter keep-alive main loop
-        while True:
-            if self.stopped():
-                self.shutdown()
-                break
-            sleep(1)
+def harmonization(mode=DEFAULT_HARMONIZATION_MODE, key="C"):
+    """Returns the Harmonization() of one of the HARMONIZATION_MODES, for a song in the given key."""
+    if mode == "major":
+        return Harmonization(mode, major_scale)
+    if mode == "chord":
+        return Harmonization(mode)
+    if mode == "key":
+        scale = scales.NaturalMinor(_tonic(key)) if key.islower() else scales.Major(key)
+        return Harmonization(mode, _scale_pitches(scale))
+    if mode == "minor":
+        return Harmonization(mode, _scale_pitches(scales.NaturalMinor(_tonic(key))))
+    if mode in MODAL_HARMONIZATION_MODES:
+        return Harmonization(mode, _scale_pitches(getattr(scales, mode.capitalize())(_tonic(key))))
+    if mode == "white_keys":
+        return Harmonization(mode, [pitch for pitch in range(12) if pitch not in black_key_map], chord_tones=False)
+    raise ValueError("Unknown harmonization mode '{}', expected one of {}".format(mode, HARMONIZATION_MODES))
+
+
+def harmonization_table(chord, mode=DEFAULT_HARMONIZATION_MODE, key="C"):
+    """Returns the table of the given harmonization mode for a chord, see Harmonization.table()."""
+    return harmonization(mode, key).table(chord)
+
+
+def fit_note(note, chord, mode=DEFAULT_HARMONIZATION_MODE, key="C"):
+    """Moves a note onto the closest valid note for the given chord, which is a list of MIDI pitches."""
+    table = harmonization_table(chord, mode, key)
+    if table is not None:
+        note = table[note]
+    return note
+
+
+class MidiHarmonizer(MidiPortProxy):
+    """
+    Relays MIDI messages by proxying a MIDI connection between virtual or hardware ports.
+    Applies a harmonization algorithm to MIDI messages on specific channels.
+    """
+
+    def __init__(self, port_in_name, port_out_name, melody_channel=1, bass_channel=2, chord_channel=3, callback=None,
+                 mode=DEFAULT_HARMONIZATION_MODE, key="C"):
+        super(MidiHarmonizer, self).__init__(port_in_name, port_out_name, callback)
+        self.melody_channel = melody_channel
+        self.bass_channel = bass_channel
+        self.chord_channel = chord_channel
+        self.midi_state = MidiState()
+        self._harmonization = harmonization(mode, key)
+        # The harmonization table of the chord that is currently held, or None if there is nothing to harmonize to.
+        self._table = self._harmonization.table([])
+        # Lock for replacing the table when the chord or the harmonization changes.
+        self._table_lock = Lock()
+
+    @property
+    def mode(self):
+        return self._harmonization.name
+
+    def set_mode(self, mode, key="C"):
+        """Switches to one of the HARMONIZATION_MODES, for a song in the given key."""
+        with self._table_lock:
+            self._harmonization = harmonization(mode, key)
+            self._table = self._harmonization.table(self.midi_state.active_notes(self.chord_channel))
 
     def fit_note(self, note):
-        # TODO: possibly add scale notes to valid notes
-        chord = self.midi_state.active_notes(self.chord_channel)
-        # TODO: this currently maps to black AND white keys, MelodicFlow maps only to white keys.
-        # This extends the range on the keyboard, but this solution should be more easily compatible
-        # with generated output, as we don't have to transpose the black keys.
-        # TODO: do not recompute if same chord as before (cache valid notes)
-        if chord:
-            middle_octave_chords = 4
-            middle_octave_melody = 8
-
-            # If the input note is too low, transpose it upwards
-            # to apply the harmonisation, then transpose it back down.
-            transposed_octave = 0
-            while note < (middle_octave_melody * 12):
-                note += 12
-                transposed_octave += 1
-
-            # Root C note of all octaves
-            octaves = list(range(0, 127, 12))
-
-            # normalize chord to C0, then generate tranposed chords for every octave
-            lowest, count = min(chord), -1
-            while lowest >= 0:
-                count += 1
-                lowest -= 12
-            mapped_over_range = [[e - (12 * count) + octave for e in chord] for octave in octaves]
-
-            # get valid notes, split for positive and negative movement
-            f_a = SortedSet([e for l in mapped_over_range[:middle_octave_chords] for e in l])
-            f_a.update([e for l in major_notes[:middle_octave_chords] for e in l])
-            f_b = SortedSet([e for l in mapped_over_range[middle_octave_chords:] for e in l])
-            f_b.update([e for l in major_notes[middle_octave_chords:] for e in l])
-
-            # get relative distance from played key to middle C of melody
-            diff = note - octaves[middle_octave_melody]
-
-            note -= transposed_octave * 12
-            # clamp to valid note range
-            diff = max(-len(f_a), min(diff, len(f_b) - 1))
-
-            # jump to next valid note, either up or down
-            if diff < 0:
-                note = f_a[len(f_a) + diff]
-            else:
-                note = f_b[diff]
-
-            # clamp note to valid MIDI note range
-            note = max(0, min(note, 127))
-
-        return note
-
-    def handle_message(self, msg):
+        return note if self._table is None else self._table[note]
+
+    def process(self, msg):
         # Update MidiState
         self.midi_state.handle_message(msg)
 
+        # Look up the harmonization table only when the chord changes
+        if msg.type in ["note_on", "note_off"] and msg.channel == self.chord_channel:
+            with self._table_lock:
+                self._table = self._harmonization.table(self.midi_state.active_notes(self.chord_channel))
+
         new_msg = msg.copy()
 
         # Modify only note messages on the melody channel
@@ -130,4 +191,4 @@ class MidiHarmonizer(Thread):
         if self.callback:
             self.callback(msg, new_msg)
 
-        self.port_out.send(new_msg)
+        return new_msg
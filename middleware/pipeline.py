@@ -0,0 +1,126 @@
+### System ###
+from time import time, perf_counter
+from queue import Queue
+from threading import Lock, Thread
+
+### Mido ###
+from mido import ports
+
+### Local ###
+from .port_proxy import MidiPortProxy
+
+# Put into the message queue to stop the stage thread.
+_STOP_MESSAGE = None
+
+
+class PipelinePort(ports.BaseOutput):
+    """An output port that hands messages to a MiddlewarePipeline() within the process, in place of a virtual port."""
+
+    def __init__(self, pipeline, name=None):
+        self._pipeline = pipeline
+        super(PipelinePort, self).__init__(name)
+
+    def _send(self, msg):
+        self._pipeline.handle_message(msg)
+
+
+class StageStats():
+    """Counts the messages a pipeline stage has processed and the time it took for them."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, duration):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total_time / self.count if self.count else None,
+            "max": self.max_time,
+        }
+
+
+class MiddlewarePipeline(MidiPortProxy):
+    """
+    Passes MIDI messages through a chain of middleware stages within the process, e.g. harmonizer, recorder and
+    keyboard display, instead of relaying them between the stages over virtual MIDI ports.
+    A stage is an object with a process() method, which returns the message for the next stage or None to drop it.
+    Stages that need to know when a message arrived, like the recorder, can provide a process_received() method
+    instead, which is also passed the time at which the message entered the pipeline.
+    Stages that are MidiPortProxy()s are started and stopped with the pipeline and share its output port.
+    Messages enter through 'port', or through the input port if 'port_in_name' is given, and only the output
+    of the last stage leaves the process.
+    Entering messages are only queued, the stages run on a thread of their own. That way slow stages, like the
+    recorder writing to disk, do not hold up the thread that sends the messages, e.g. a PlaybackScheduler().
+    """
+
+    def __init__(self, stages, port_out_name, port_in_name=None, name="Middleware Pipeline"):
+        super(MiddlewarePipeline, self).__init__(port_in_name, port_out_name)
+        self.stages = list(stages)
+        self.port = PipelinePort(self, name)
+        # (message, time received) tuples waiting for the stage thread.
+        self._queue = Queue()
+        self._stage_thread = Thread(target=self._run_stages, name="MiddlewarePipeline", daemon=True)
+        # The processing times of every stage, guarded by a lock so that stats() can be read from other threads.
+        self._stats = []
+        for stage in self.stages:
+            name = stage.__class__.__name__
+            count = sum(1 for _, stats in self._stats if stats.name.split(" ")[0] == name)
+            self._stats.append((stage, StageStats(name if not count else "{} {}".format(name, count + 1))))
+        self._stats_lock = Lock()
+
+    def setup(self):
+        for stage in self.stages:
+            if isinstance(stage, MidiPortProxy):
+                stage.start(port_out=self.port_out)
+        self._stage_thread.start()
+
+    def shutdown(self):
+        self.port.close()
+        # Let the stages finish the messages that are already queued.
+        self._queue.put(_STOP_MESSAGE)
+        self._stage_thread.join()
+        for stage in self.stages:
+            if isinstance(stage, MidiPortProxy):
+                stage.stop()
+        super(MiddlewarePipeline, self).shutdown()
+
+    def handle_message(self, msg):
+        # Timestamped here, so that the time spent waiting for the stage thread does not count as timing jitter.
+        self._queue.put((msg, time()))
+
+    def _run_stages(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP_MESSAGE:
+                break
+            msg = self.process(*item)
+            if msg is not None:
+                self.port_out.send(msg)
+
+    def process(self, msg, received_time=None):
+        """Passes a message through all stages, as received at 'received_time' or now."""
+        if received_time is None:
+            received_time = time()
+        with self._stats_lock:
+            for stage, stats in self._stats:
+                started = perf_counter()
+                if hasattr(stage, "process_received"):
+                    msg = stage.process_received(msg, received_time)
+                else:
+                    msg = stage.process(msg)
+                stats.record(perf_counter() - started)
+                if msg is None:
+                    break
+        return msg
+
+    def stats(self):
+        """Returns the processing times of the stages, keyed by their class names in order."""
+        with self._stats_lock:
+            return {stats.name: stats.to_dict() for _, stats in self._stats}
@@ -0,0 +1,97 @@
+### System ###
+from threading import Event, Lock
+
+### Mido ###
+from mido import open_input, open_output, get_input_names, get_output_names  # pylint: disable-msg=no-name-in-module
+
+
+def open_port(name, output=False):
+    """Opens the hardware or virtual port with the given name, creating a virtual port if none exists."""
+    if output:
+        return open_output(name, virtual=name not in get_output_names())
+    return open_input(name, virtual=name not in get_input_names())
+
+
+class MidiPortProxy():
+    """
+    Relays MIDI messages from an input to an output port, passing each one through process().
+    Messages are handled on the callback thread of the input port, so a running proxy has no thread of its own.
+    Without an input port name, messages are only relayed when handle_message() is called directly, e.g. by a
+    MiddlewarePipeline().
+    Supports the start(), stop(), join() and is_alive() methods of a Thread(), and can only be started once.
+    """
+
+    def __init__(self, port_in_name, port_out_name, callback=None):
+        self.port_in_name = port_in_name
+        self.port_in = None
+        self.port_out_name = port_out_name
+        self.port_out = None
+        self.callback = callback
+        # Whether the output port was opened by the proxy, rather than handed to start().
+        self._owns_port_out = True
+        self._lock = Lock()
+        self._started = False
+        self._stop_event = Event()
+        # An event that is set once the ports have been shut down.
+        self._finished = Event()
+
+    def start(self, port_out=None):
+        """Opens the ports and goes live. If an open 'port_out' is given, it is used and left open on shutdown."""
+        with self._lock:
+            if self._started:
+                raise RuntimeError("{} can only be started once".format(self.__class__.__name__))
+            self._started = True
+            if self._stop_event.is_set():
+                self._finished.set()
+                return
+            if self.port_in_name is not None:
+                self.port_in = open_port(self.port_in_name)
+            self._owns_port_out = port_out is None
+            self.port_out = open_port(self.port_out_name, output=True) if port_out is None else port_out
+            self.setup()
+
+            # Set the callback and go live
+            if self.port_in is not None:
+                self.port_in.callback = self.handle_message
+
+    def setup(self):
+        """Called once the ports are open, before the first message is handled."""
+
+    def stop(self):
+        with self._lock:
+            if self._stop_event.is_set():
+                return
+            self._stop_event.set()
+            if self._started:
+                if self.port_in is not None:
+                    self.port_in.callback = None
+                self.shutdown()
+                self._finished.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def is_alive(self):
+        return self._started and not self._finished.is_set()
+
+    def join(self, timeout=None):
+        if not self._started:
+            raise RuntimeError("Cannot join {} before it is started".format(self.__class__.__name__))
+        self._finished.wait(timeout)
+
+    def shutdown(self):
+        if self.port_in is not None:
+            self.port_in.close()
+        if self._owns_port_out:
+            self.port_out.close()
+
+    def process(self, msg):
+        """Handles a message and returns the message to relay, or None to drop it."""
+        if self.callback:
+            self.callback(msg)
+        return msg
+
+    def handle_message(self, msg):
+        msg = self.process(msg)
+        if msg is not None:
+            self.port_out.send(msg)
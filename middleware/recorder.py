@@ -1,78 +1,173 @@
 ### System ###
-from time import sleep, time
-from threading import Thread, Event
+import os
+import logging
+from time import time, strftime
+from queue import Queue, Empty
+from threading import Thread
 from decimal import Decimal, ROUND_DOWN, localcontext
 
 ### Mido ###
 from mido.midifiles.tracks import _to_reltime
 from mido.midifiles.units import second2tick, bpm2tempo
-from mido import open_input, open_output, get_input_names, get_output_names, MidiFile, MidiTrack, Message # pylint: disable-msg=no-name-in-module, line-too-long
+from mido import MidiFile, MidiTrack, Message # pylint: disable-msg=no-name-in-module
 
+### Local ###
+from .port_proxy import MidiPortProxy
 
-class MidiRecorder(Thread):
+# Instrument programs of the melody, bass and chord channels.
+CHANNEL_PROGRAMS = {1: 57, 2: 68, 3: 1}
+
+# Drums and channel 0 are recorded into the first track, channels 1-3 into tracks of their own.
+_TRACK_COUNT = 4
+
+JOURNAL_SUFFIX = ".journal"
+
+# Put into the event queue to stop the journal writer thread.
+_STOP_EVENT = None
+
+
+def _track_index(msg):
+    """Returns the track a message is recorded into, or None if it is not recorded."""
+    channel = getattr(msg, "channel", None)
+    if channel == 9:
+        return 0
+    if channel is not None and channel < _TRACK_COUNT:
+        return channel
+    return None
+
+
+def read_journal(journal_path):
+    """
+    Reads the events of a recording journal into one list of messages per track, with absolute times in ticks.
+    A journal that was cut off, e.g. by a crash, is read up to its last complete event.
+    """
+    tracks = [[] for _ in range(_TRACK_COUNT)]
+    with open(journal_path, "r", encoding="utf-8") as journal:
+        for line in journal:
+            if not line.endswith("\n"):
+                break
+            try:
+                track, tick, data = line.split()
+                tracks[int(track)].append(Message.from_bytes(bytes.fromhex(data), time=int(tick)))
+            except (ValueError, IndexError):
+                logging.warning("Stopped reading '{}' at malformed event: {!r}".format(journal_path, line))
+                break
+    return tracks
+
+
+def recover_recording(journal_path, path):
+    """Rebuilds a MIDI file from a recording journal, which may be incomplete. Returns the number of events."""
+    tracks = read_journal(journal_path)
+    midi_file = MidiFile()
+    for track in tracks:
+        midi_file.tracks.append(MidiTrack(_to_reltime(track)))
+    midi_file.save(path)
+    return sum(len(track) for track in tracks)
+
+
+class MidiRecorder(MidiPortProxy):
     """
     Records incoming MIDI messages into a properly-formed MIDI file.
     Also functions as a relay.
+    Messages are appended to a journal next to the MIDI file as they arrive, which is flushed and synced to disk
+    every 'flush_interval' seconds and turned into the MIDI file on shutdown. If the recorder does not shut down
+    cleanly, the MIDI file can be rebuilt from the journal with recover_recording(), which also happens on the
+    next start.
+    The journal is written on a thread of its own, so that disk access does not hold up the messages.
     """
 
-    def __init__(self, port_in_name, port_out_name, callback=None):
-        super(MidiRecorder, self).__init__()
-        self.port_in_name = port_in_name
-        self.port_in = None
-        self.port_out_name = port_out_name
-        self.port_out = None
-        self.callback = callback
+    def __init__(self, port_in_name, port_out_name, callback=None, path="recording.mid", flush_interval=1.0):
+        super(MidiRecorder, self).__init__(port_in_name, port_out_name, callback)
         self.first_time = None
-        self.tracks = [MidiTrack(), MidiTrack(), MidiTrack(), MidiTrack()]
-        self._stop_event = Event()
-
-    def stop(self):
-        self._stop_event.set()
-
-    def stopped(self):
-        return self._stop_event.is_set()
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.flush_interval = flush_interval
+        # Events waiting for the journal writer thread.
+        self._events = Queue()
+        self._writer_thread = None
+        # The exception that stopped the journal writer thread, if any.
+        self._writer_error = None
 
     def shutdown(self):
-        self.port_in.close()
-        self.port_out.close()
-        midi_file = MidiFile()
-        for track in self.tracks:
-            t = MidiTrack(_to_reltime(track))
-            midi_file.tracks.append(t)
-        midi_file.save("recording.mid")
-
-    def run(self):
-        if self.port_in_name in get_input_names():
-            self.port_in = open_input(self.port_in_name, virtual=False)
-        else:
-            self.port_in = open_input(self.port_in_name, virtual=True)
-
-        if self.port_out_name in get_output_names():
-            self.port_out = open_output(self.port_out_name, virtual=False)
-        else:
-            self.port_out = open_output(self.port_out_name, virtual=True)
-
-        self.port_out.send(Message(type="program_change", program=57, channel=1))
-        self.port_out.send(Message(type="program_change", program=68, channel=2))
-        self.port_out.send(Message(type="program_change", program=1, channel=3))
-
-        # Set the callback and go live
-        self.port_in.callback = self.handle_message
-
-        # Enter keep-alive main loop
-        while True:
-            if self.stopped():
-                self.shutdown()
-                break
-            sleep(1)
-
-    def handle_message(self, msg):
+        super(MidiRecorder, self).shutdown()
+        # Let the writer finish the events that are already queued.
+        self._events.put(_STOP_EVENT)
+        self._writer_thread.join()
+        if self._writer_error is not None:
+            logging.error("The recording '{}' is incomplete, writing its journal failed: {}".format(
+                self.path, self._writer_error))
+        try:
+            recover_recording(self.journal_path, self.path)
+        except (OSError, ValueError):
+            logging.exception("Failed to write recording '{}', the journal '{}' is kept".format(
+                self.path, self.journal_path))
+            return
+        os.remove(self.journal_path)
+
+    def _rescue_journal(self):
+        """Turns the journal left behind by a session that did not shut down cleanly into a MIDI file of its own."""
+        root, extension = os.path.splitext(self.path)
+        rescued_path = "{}-{}{}".format(root, strftime("%Y%m%d-%H%M%S"), extension)
+        try:
+            count = recover_recording(self.journal_path, rescued_path)
+        except (OSError, ValueError):
+            logging.exception("Failed to recover the previous recording from '{}'".format(self.journal_path))
+            # Keep the journal, under the name recover.py expects for the rescued MIDI file.
+            os.replace(self.journal_path, rescued_path + JOURNAL_SUFFIX)
+            return
+        logging.warning("Recovered {} events of the previous recording from '{}' into '{}'".format(
+            count, self.journal_path, rescued_path))
+        os.remove(self.journal_path)
+
+    def setup(self):
+        if os.path.exists(self.journal_path):
+            self._rescue_journal()
+        journal = open(self.journal_path, "w", encoding="utf-8")
+        self._writer_thread = Thread(target=self._write_journal, args=(journal,), name="MidiRecorder", daemon=True)
+        self._writer_thread.start()
+        for channel, program in CHANNEL_PROGRAMS.items():
+            self.port_out.send(Message(type="program_change", program=program, channel=channel))
+
+    @staticmethod
+    def _sync_journal(journal):
+        """Writes the buffered events to disk, so that they survive a crash."""
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _write_journal(self, journal):
+        last_flush = time()
+        try:
+            with journal:
+                while True:
+                    try:
+                        event = self._events.get(timeout=self.flush_interval)
+                    except Empty:
+                        event = ()
+                    if event is _STOP_EVENT:
+                        break
+                    if event:
+                        track, tick, data = event
+                        journal.write("{} {} {}\n".format(track, tick, bytes(data).hex()))
+                    if time() - last_flush >= self.flush_interval:
+                        self._sync_journal(journal)
+                        last_flush = time()
+                self._sync_journal(journal)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.exception("Failed to write the recording journal '{}', recording stopped".format(
+                self.journal_path))
+            self._writer_error = e
+
+    def process(self, msg):
+        return self.process_received(msg, time())
+
+    def process_received(self, msg, received_time):
+        """Records a message at 'received_time', e.g. the time it entered a MiddlewarePipeline()."""
         # truncate time value to 3-digit precision
         # this is done because the magenta-emitted time values
         # are distorted and precision is lost in transmission.
         # 3 digits is the most precise we can get
         with localcontext() as ctx:
-            tm = float(Decimal(time()).quantize(Decimal("0.001"), rounding=ROUND_DOWN))
+            tm = float(Decimal(received_time).quantize(Decimal("0.001"), rounding=ROUND_DOWN))
             if not self.first_time:
                 self.first_time = tm
                 tm = 0
@@ -81,15 +176,12 @@ class MidiRecorder(Thread):
             tk = int(second2tick(tm, 480, bpm2tempo(120)))
             msg.time = tk
 
-        try:
-            if msg.channel == 9:
-                self.tracks[0].append(msg)
-            else:
-                self.tracks[msg.channel].append(msg)
-        except (IndexError, AttributeError):
-            pass
+        track = _track_index(msg)
+        # Once the journal writer has failed, nothing takes the events off the queue anymore.
+        if track is not None and self._writer_error is None:
+            self._events.put((track, msg.time, msg.bytes()))
 
         if self.callback:
             self.callback(msg)
 
-        self.port_out.send(msg)
+        return msg
@@ -2,14 +2,10 @@
 import logging
 from enum import Enum
 from time import time
-from time import sleep
-from threading import Thread, Event
-
-### Mido ###
-from mido import open_input, open_output, get_input_names, get_output_names  # pylint: disable-msg=no-name-in-module
 
 ### Local ###
 from .midi_meta import white_keys, black_keys_flattened, MidiState
+from .port_proxy import MidiPortProxy
 
 DELIMITER_MAP = sorted([e[2] for e in white_keys] + [e[5] for e in white_keys])
 
@@ -204,51 +200,19 @@ class Keyboard():
         if dead_keys:
             logging.info("Dead Keys: {}".format(dead_keys))
 
+    def process(self, msg):
+        """Shows the message as a stage of a MiddlewarePipeline()."""
+        self.handle_message(msg)
+        return msg
+
 
-class MidiPiano(Thread):
+class MidiPiano(MidiPortProxy):
 
     def __init__(self, port_in_name, port_out_name, callback=None):
-        super(MidiPiano, self).__init__()
-        self.port_in_name = port_in_name
-        self.port_in = None
-        self.port_out_name = port_out_name
-        self.port_out = None
-        self.callback = callback
+        super(MidiPiano, self).__init__(port_in_name, port_out_name, callback)
         self.keyboard = Keyboard()
-        self._stop_event = Event()
-
-    def stop(self):
-        self._stop_event.set()
-
-    def stopped(self):
-        return self._stop_event.is_set()
-
-    def shutdown(self):
-        self.port_in.close()
-        self.port_out.close()
-
-    def run(self):
-        if self.port_in_name in get_input_names():
-            self.port_in = open_input(self.port_in_name, virtual=False)
-        else:
-            self.port_in = open_input(self.port_in_name, virtual=True)
-
-        if self.port_out_name in get_output_names():
-            self.port_out = open_output(self.port_out_name, virtual=False)
-        else:
-            self.port_out = open_output(self.port_out_name, virtual=True)
 
-        # Set the callback and go live
-        self.port_in.callback = self.handle_message
-
-        # Enter keep-alive main loop
-        while True:
-            if self.stopped():
-                self.shutdown()
-                break
-            sleep(1)
-
-    def handle_message(self, msg):
+    def process(self, msg):
         self.keyboard.handle_message(msg)
 
         print("\033c")
@@ -257,4 +221,4 @@ class MidiPiano(Thread):
         if self.callback:
             self.callback(msg)
 
-        self.port_out.send(msg)
+        return msg
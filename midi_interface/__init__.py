@@ -1,2 +1,3 @@
 from .midi_hub import MidiHub, TextureType
+from .part_generator import GeneratorService, PartGenerator
 from .midi_interaction import SongStructureMidiInteraction
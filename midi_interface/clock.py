@@ -0,0 +1,76 @@
+"""
+Clocks for timing MIDI capture and playback.
+"""
+
+### System ###
+import time
+import threading
+
+# Timeouts of blocking calls are cut into slices of this many real seconds while a FakeClock() is in use,
+# so that waiting threads notice when the fake time has been advanced.
+_FAKE_CLOCK_POLL_INTERVAL = 0.001
+
+
+class Clock():
+    """
+    A monotonic high-resolution clock in seconds, which is not affected by adjustments of the system time.
+    Its epoch is arbitrary, so times of this clock must not be mixed with time.time().
+    """
+
+    def time(self):
+        """Returns the current time in seconds."""
+        return time.perf_counter_ns() / 1e9
+
+    def sleep_until(self, deadline):
+        """Blocks until the clock has reached 'deadline'."""
+        while True:
+            remaining = deadline - self.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def sleep(self, seconds):
+        """Blocks for 'seconds' on this clock."""
+        self.sleep_until(self.time() + seconds)
+
+    def timeout(self, seconds):
+        """Converts a timeout on this clock into real seconds, for blocking calls like Condition.wait()."""
+        return max(0.0, seconds)
+
+
+class FakeClock(Clock):
+    """
+    A clock that only moves when it is advanced explicitly, for running timing logic deterministically
+    and faster than real time.
+    """
+
+    def __init__(self, start_time=0.0):
+        self._time = start_time
+        self._advanced = threading.Condition()
+
+    def time(self):
+        with self._advanced:
+            return self._time
+
+    def advance(self, seconds):
+        """Moves the clock forward by 'seconds' and wakes up all threads sleeping on it."""
+        with self._advanced:
+            self._time += seconds
+            self._advanced.notify_all()
+
+    def advance_to(self, new_time):
+        """Moves the clock forward to 'new_time', if it is not already past it."""
+        with self._advanced:
+            self._time = max(self._time, new_time)
+            self._advanced.notify_all()
+
+    def sleep_until(self, deadline):
+        with self._advanced:
+            self._advanced.wait_for(lambda: self._time >= deadline)
+
+    def timeout(self, seconds):
+        return min(max(0.0, seconds), _FAKE_CLOCK_POLL_INTERVAL)
+
+
+# The clock used by all MIDI components unless another one is given.
+DEFAULT_CLOCK = Clock()
@@ -0,0 +1,16 @@
+"""
+Serialization of methods on the lock of their instance, like magenta.common.concurrency.
+Importing magenta.common would import TensorFlow, which the MIDI components have no use for.
+"""
+
+### System ###
+import functools
+
+
+def serialized(func):
+    """Decorates a method so that it is run while holding the '_lock' of its instance."""
+    @functools.wraps(func)
+    def serialized_method(self, *args, **kwargs):
+        with self._lock:  # pylint: disable-msg=protected-access
+            return func(self, *args, **kwargs)
+    return serialized_method
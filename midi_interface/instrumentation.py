@@ -0,0 +1,154 @@
+"""
+Opt-in timing instrumentation of MIDI dispatch, recorded into HDR-style histograms.
+"""
+
+### System ###
+import os
+import json
+import logging
+from threading import Lock
+
+# Values below 2 ** _SUB_BUCKET_BITS units are counted exactly, larger ones in buckets of about 1.5% width.
+_SUB_BUCKET_BITS = 7
+_SUB_BUCKET_COUNT = 1 << _SUB_BUCKET_BITS
+_SUB_BUCKET_HALF_COUNT = _SUB_BUCKET_COUNT >> 1
+
+_PERCENTILES = [50, 90, 99, 99.9]
+
+
+def _bucket_index(units):
+    if units < _SUB_BUCKET_COUNT:
+        return units
+    shift = units.bit_length() - _SUB_BUCKET_BITS
+    return shift * _SUB_BUCKET_HALF_COUNT + (units >> shift)
+
+
+def _bucket_value(index):
+    """Returns the lowest value in units that is counted in the bucket with the given index."""
+    if index < _SUB_BUCKET_COUNT:
+        return index
+    shift = index // _SUB_BUCKET_HALF_COUNT - 1
+    return (index - shift * _SUB_BUCKET_HALF_COUNT) << shift
+
+
+class Histogram():
+    """
+    Counts values in buckets whose width grows with their magnitude, so that every recorded value is kept with
+    the same relative precision and recording takes constant time and memory, however many values there are.
+    Values are recorded as multiples of 1 / 'scale', e.g. a scale of 1e6 records seconds in microseconds.
+    """
+
+    def __init__(self, unit="s", scale=1e6):
+        self.unit = unit
+        self.scale = scale
+        self._lock = Lock()
+        self._counts = {}
+        self._count = 0
+        self._total = 0.0
+        self._min = None
+        self._max = None
+
+    def record(self, value):
+        """Counts a value. Negative values are counted as zero."""
+        value = max(0.0, value)
+        index = _bucket_index(int(value * self.scale))
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self._count += 1
+            self._total += value
+            self._min = value if self._min is None else min(self._min, value)
+            self._max = value if self._max is None else max(self._max, value)
+
+    def percentile(self, percent):
+        """Returns the value below which 'percent' percent of the recorded values lie, within bucket precision."""
+        with self._lock:
+            if not self._count:
+                return None
+            rank = max(1, int(round(percent / 100.0 * self._count)))
+            seen = 0
+            for index in sorted(self._counts):
+                seen += self._counts[index]
+                if seen >= rank:
+                    return min(_bucket_value(index) / self.scale, self._max)
+        return self._max
+
+    def __len__(self):
+        return self._count
+
+    def to_dict(self):
+        """Summarizes the histogram, including its non-empty buckets keyed by their lowest value."""
+        with self._lock:
+            summary = {
+                "unit": self.unit,
+                "count": self._count,
+                "min": self._min,
+                "max": self._max,
+                "mean": self._total / self._count if self._count else None,
+                "buckets": {str(_bucket_value(index) / self.scale): count
+                            for index, count in sorted(self._counts.items())},
+            }
+        for percent in _PERCENTILES:
+            summary["p{}".format(percent)] = self.percentile(percent)
+        return summary
+
+
+class Instrumentation():
+    """A set of named histograms, which MIDI components record into while instrumentation is enabled."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+
+    def histogram(self, name, unit="s", scale=1e6):
+        """Returns the histogram with the given name, creating it if it does not exist yet."""
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(unit, scale)
+            return self._histograms[name]
+
+    def record(self, name, value, unit="s", scale=1e6):
+        self.histogram(name, unit, scale).record(value)
+
+    def record_count(self, name, value):
+        """Records a number of items, such as a queue depth."""
+        self.record(name, value, unit="items", scale=1)
+
+    def to_dict(self):
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {name: histogram.to_dict() for name, histogram in sorted(histograms.items())}
+
+    def log(self):
+        """Writes the percentiles of all histograms to the log."""
+        for name, summary in self.to_dict().items():
+            if not summary["count"]:
+                continue
+            logging.info("{}: {} samples | mean {:.6g}{unit} | p50 {:.6g}{unit} | p90 {:.6g}{unit} | "
+                         "p99 {:.6g}{unit} | p99.9 {:.6g}{unit} | max {:.6g}{unit}".format(
+                             name, summary["count"], summary["mean"], summary["p50"], summary["p90"],
+                             summary["p99"], summary["p99.9"], summary["max"],
+                             unit=summary["unit"] if summary["unit"] == "s" else " " + summary["unit"]))
+
+    def dump(self, path):
+        """Writes all histograms to a JSON file, creating its directory if needed."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2, sort_keys=True)
+        logging.info("Wrote MIDI instrumentation to '{}'".format(path))
+
+
+# The active instrumentation, or None while instrumentation is disabled.
+_instrumentation = None
+
+
+def enable_instrumentation():
+    """Enables instrumentation for all MIDI components created from now on and returns it."""
+    global _instrumentation
+    if _instrumentation is None:
+        _instrumentation = Instrumentation()
+    return _instrumentation
+
+
+def get_instrumentation():
+    """Returns the active Instrumentation(), or None if instrumentation is disabled."""
+    return _instrumentation
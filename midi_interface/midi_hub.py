@@ -15,21 +15,26 @@
 ### System ###
 import re
 import abc
-import time
+import heapq
 import logging
+import itertools
 import threading
 from queue import Queue, Empty
+from contextlib import contextmanager
 from collections import defaultdict, deque
 
+### Sorted Containers ###
+from sortedcontainers import SortedList
+
 ### Mido ###
 from mido import Message, messages, ports, get_input_names, get_output_names, open_input, open_output  # pylint: disable-msg=no-name-in-module, line-too-long
+from mido.frozen import freeze_message
 
-### Tensorflow ###
-import tensorflow as tf
-
-### Magenta ###
-from magenta.common import concurrency
-from magenta.protobuf import music_pb2
+### Local ###
+from . import concurrency
+from .clock import DEFAULT_CLOCK
+from .note_array import NoteBuffer
+from .instrumentation import get_instrumentation
 
 _DEFAULT_METRONOME_TICK_DURATION = 0.05
 _DEFAULT_METRONOME_PROGRAM = 117  # Melodic Tom
@@ -45,6 +50,27 @@ _DEFAULT_METRONOME_CHANNEL = 1
 _DRUM_CHANNEL = 9
 
 
+# Callbacks of signals are run on a bounded pool of worker threads. When its queue is full, the dispatching
+# thread waits up to _CALLBACK_SUBMIT_TIMEOUT seconds for room before the callback is dropped.
+_CALLBACK_WORKERS = 4
+_CALLBACK_QUEUE_SIZE = 256
+_CALLBACK_SUBMIT_TIMEOUT = 0.05
+
+_CALLBACK_IDS = itertools.count()
+
+# The attribute that holds the number of note and control messages, by which signals are indexed.
+_NUMBER_ATTRIBUTES = {
+    'note_on': 'note',
+    'note_off': 'note',
+    'control_change': 'control',
+}
+
+
+def _message_key(msg):
+    """Orders queued playback messages by time and pitch."""
+    return msg.time, getattr(msg, 'note', -1)
+
+
 class MidiHubException(Exception):
     pass
 
@@ -105,6 +131,41 @@ class MidiSignal():
         self._type = type_
         self._inferred_types = inferred_types
 
+        # The attribute values a matching message must have, if the type is known.
+        if type_ is None:
+            self._values = None
+        else:
+            value_names = messages.SPEC_BY_TYPE[type_]['value_names']
+            if msg is not None:
+                self._values = {name: getattr(msg, name) for name in value_names}
+            else:
+                self._values = {name: value for name, value in kwargs.items() if name in value_names}
+        # Compiled lazily, for signals that can only be matched with their regex.
+        self._regex = None
+
+    @property
+    def key(self):
+        """
+        The (type, number) key under which a SignalIndex() looks up this signal, where number is the note or
+        control number the signal requires, if any. None if the signal can only be matched with its regex.
+        """
+        if self._values is None:
+            return None
+        return self._type, self._values.get(_NUMBER_ATTRIBUTES.get(self._type))
+
+    def matches(self, msg):
+        """Returns whether a message matches this signal, without formatting it unless the type is unknown."""
+        if self._values is None:
+            if self._regex is None:
+                self._regex = re.compile(str(self))
+            return self._regex.match(str(msg)) is not None
+        if msg.type != self._type:
+            return False
+        for name, value in self._values.items():
+            if getattr(msg, name) != value:
+                return False
+        return True
+
     def to_message(self):
         if self._msg:
             return self._msg
@@ -130,81 +191,339 @@ class MidiSignal():
         return regex_pattern
 
 
-class Metronome(threading.Thread):
-    daemon = True
-
-    def __init__(self, outport, qpm, start_time, stop_time=None, program=_DEFAULT_METRONOME_PROGRAM,
-                 signals=None, duration=_DEFAULT_METRONOME_TICK_DURATION, channel=None):
-        self._outport = outport
-        self.update(qpm, start_time, stop_time, program, signals, duration, channel)
-        super(Metronome, self).__init__()
-
-    def update(self, qpm, start_time, stop_time=None, program=_DEFAULT_METRONOME_PROGRAM,
-               signals=None, duration=_DEFAULT_METRONOME_TICK_DURATION, channel=None):
-        # Locking is not required since variables are independent and assignment is
-        # atomic.
-        self._channel = _DEFAULT_METRONOME_CHANNEL if channel is None else channel
-
-        # Set the program number for the channels.
-        self._outport.send(Message(type='program_change', program=program, channel=self._channel))
-        self._period = 60. / qpm
-        self._start_time = start_time
-        self._stop_time = stop_time
-        self._messages = (_DEFAULT_METRONOME_MESSAGES if signals is None else
-                          [s.to_message() if s else None for s in signals])
-        self._duration = duration
+class SignalIndex():
+    """
+    Maps MidiSignal()s to values and finds the values of all signals matching a message.
+    Signals are indexed by message type and note or control number, so that looking up a message costs a few
+    dict lookups. Only signals of an unknown type fall back to regex matching.
+    """
+
+    def __init__(self):
+        # Lists of [signal, value] entries keyed by the (type, number) key of their signal.
+        self._entries = defaultdict(list)
+        # Entries of signals without a key, which are matched with their regex.
+        self._fallback_entries = []
+        self._size = 0
+
+    def _candidates(self, msg):
+        keys = [(msg.type, None)]
+        if msg.type in _NUMBER_ATTRIBUTES:
+            keys.append((msg.type, getattr(msg, _NUMBER_ATTRIBUTES[msg.type])))
+        for key in keys:
+            if key in self._entries:
+                yield key, self._entries[key]
+        if self._fallback_entries:
+            yield None, self._fallback_entries
+
+    def _bucket(self, key):
+        return self._fallback_entries if key is None else self._entries[key]
+
+    def add(self, signal, value):
+        self._bucket(signal.key).append([signal, value])
+        self._size += 1
+
+    def get(self, signal):
+        """Returns the value of a signal with the same pattern as 'signal', or None."""
+        key = signal.key
+        if key is not None and key not in self._entries:
+            return None
+        pattern = str(signal)
+        for entry_signal, value in self._bucket(key):
+            if str(entry_signal) == pattern:
+                return value
+        return None
+
+    def matching(self, msg):
+        """Returns the values of all signals that match 'msg'."""
+        if not self._size:
+            return []
+        return [value for _, entries in self._candidates(msg) for signal, value in entries if signal.matches(msg)]
+
+    def pop_matching(self, msg):
+        """Removes the signals that match 'msg' and returns their values."""
+        if not self._size:
+            return []
+        values = []
+        for key, entries in list(self._candidates(msg)):
+            remaining = []
+            for signal, value in entries:
+                if signal.matches(msg):
+                    values.append(value)
+                else:
+                    remaining.append([signal, value])
+            self._remove_entries(key, entries, remaining)
+        return values
+
+    def pop(self, signal=None):
+        """Removes the signals with the same pattern as 'signal', or all if it is None, and returns their values."""
+        pattern = None if signal is None else str(signal)
+        values = []
+        for key, entries in list(self._entries.items()) + [(None, self._fallback_entries)]:
+            remaining = []
+            for entry_signal, value in entries:
+                if pattern is None or str(entry_signal) == pattern:
+                    values.append(value)
+                else:
+                    remaining.append([entry_signal, value])
+            self._remove_entries(key, entries, remaining)
+        return values
+
+    def _remove_entries(self, key, entries, remaining):
+        self._size -= len(entries) - len(remaining)
+        if key is None:
+            self._fallback_entries = remaining
+        elif remaining:
+            self._entries[key] = remaining
+        else:
+            del self._entries[key]
+
+    def remove(self, value):
+        """Removes the signals mapped to 'value' itself."""
+        for key, entries in list(self._entries.items()) + [(None, self._fallback_entries)]:
+            remaining = [entry for entry in entries if entry[1] is not value]
+            if len(remaining) != len(entries):
+                self._remove_entries(key, entries, remaining)
+
+    def values(self):
+        return [value for entries in list(self._entries.values()) + [self._fallback_entries] for _, value in entries]
+
+    def __len__(self):
+        return self._size
+
+
+class CallbackExecutor():
+    """
+    Runs signal callbacks on a bounded pool of worker threads, which are started as they are needed.
+    Callbacks submitted with the same key, e.g. those of one registration, run one at a time and in the order they
+    were submitted. While 'max_queue_size' callbacks are waiting, submitting blocks for up to 'submit_timeout'
+    seconds, so that bursts of messages slow down the sender instead of creating threads without limit. Callbacks
+    that still find no room are dropped, counted and logged.
+    Lightweight callbacks can be run inline, in the submitting thread.
+    """
+
+    def __init__(self, max_workers=_CALLBACK_WORKERS, max_queue_size=_CALLBACK_QUEUE_SIZE,
+                 submit_timeout=_CALLBACK_SUBMIT_TIMEOUT, clock=DEFAULT_CLOCK):
+        self._max_workers = max_workers
+        self._max_queue_size = max_queue_size
+        self._submit_timeout = submit_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Notified whenever callbacks are queued, taken by a worker or finished.
+        self._changed = threading.Condition(self._lock)
+        # Keys with a callback that is ready to run, in order. A key is only ready while none of its callbacks runs.
+        self._ready = deque()
+        # Queues of waiting (fn, args, submit time) tuples, keyed by the key they were submitted with.
+        self._waiting = {}
+        self._queue_size = 0
+        self._workers = []
+        self._idle_workers = 0
+        self._shutdown = False
+        self._counts = {'submitted': 0, 'inline': 0, 'completed': 0, 'failed': 0, 'dropped': 0}
+        # Records queue depths and waiting times, if instrumentation is enabled.
+        self._instrumentation = get_instrumentation()
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:  # pylint: disable-msg=broad-except
+            self._count('failed')
+            logging.exception('Callback %s failed', getattr(fn, '__name__', fn))
+        else:
+            self._count('completed')
 
-    def run(self):
-        sleeper = concurrency.Sleeper()
+    def _run_worker(self):
         while True:
-            now = time.time()
-            tick_number = max(
-                0, int((now - self._start_time) // self._period) + 1)
-            tick_time = tick_number * self._period + self._start_time
+            with self._lock:
+                self._idle_workers += 1
+                self._changed.wait_for(lambda: self._ready or (self._shutdown and not self._waiting))
+                self._idle_workers -= 1
+                if not self._ready:
+                    break
+                key = self._ready.popleft()
+                fn, args, submit_time = self._waiting[key].popleft()
+                self._queue_size -= 1
+                self._changed.notify_all()
+            if self._instrumentation is not None:
+                self._instrumentation.record('callback_queue_wait', self._clock.time() - submit_time)
+            self._call(fn, args)
+            with self._lock:
+                # Only now may the next callback of the same key run.
+                if self._waiting[key]:
+                    self._ready.append(key)
+                else:
+                    del self._waiting[key]
+                self._changed.notify_all()
+
+    def submit(self, fn, *args, inline=False, key=None):
+        """
+        Calls 'fn' with 'args' on a worker, or right away if 'inline'. Callbacks with the same 'key' run in order,
+        without one another. Returns False if the callback was dropped.
+        """
+        if inline:
+            self._count('inline')
+            self._call(fn, args)
+            return True
+        if key is None:
+            key = object()
+        with self._lock:
+            if not self._changed.wait_for(lambda: self._queue_size < self._max_queue_size or self._shutdown,
+                                          timeout=self._submit_timeout):
+                self._counts['dropped'] += 1
+                logging.warning('Dropped callback %s, %d callbacks have been waiting for %.3fs',
+                                getattr(fn, '__name__', fn), self._queue_size, self._submit_timeout)
+                return False
+            if self._shutdown:
+                return False
+            if not self._idle_workers and len(self._workers) < self._max_workers:
+                worker = threading.Thread(target=self._run_worker, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            if key not in self._waiting:
+                self._waiting[key] = deque()
+                self._ready.append(key)
+            self._waiting[key].append((fn, args, self._clock.time()))
+            self._queue_size += 1
+            self._counts['submitted'] += 1
+            queue_size = self._queue_size
+            self._changed.notify_all()
+        if self._instrumentation is not None:
+            self._instrumentation.record_count('callback_queue_depth', queue_size)
+        return True
+
+    def stats(self):
+        """Returns the callback counters and the current queue depth."""
+        with self._lock:
+            stats = dict(self._counts)
+            stats['workers'] = len(self._workers)
+            stats['queue_depth'] = self._queue_size
+        return stats
 
-            if self._stop_time is not None and self._stop_time < tick_time:
-                break
+    def shutdown(self, wait=False):
+        """Stops the workers once the queued callbacks have run. Callbacks submitted from then on are dropped."""
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
+            self._changed.notify_all()
+        if wait:
+            for worker in workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+
+class PlaybackScheduler(threading.Thread):
+    """
+    Sends the messages of many MidiPlayer()s from a single thread.
+    A heap holds the time of the next message of every player, and all messages that are due at the same
+    time are sent together in one batch.
+    """
+    daemon = True
 
-            sleeper.sleep_until(tick_time)
+    def __init__(self, clock=DEFAULT_CLOCK):
+        self._clock = clock
+        # Lock for serialization, shared with all players of this scheduler.
+        self._lock = threading.RLock()
+        # A control variable to signal when the next message time may have changed.
+        self._update_cv = threading.Condition(self._lock)
+        # Heap of (time, order, version, player) entries for the next message of each player.
+        # Entries whose version does not match the player's version are outdated and skipped.
+        self._heap = []
+        self._order = itertools.count()
+        # An event that is set when `stop` has been called.
+        self._stop_signal = threading.Event()
+        # Records send delays and queue depths, if instrumentation is enabled.
+        self._instrumentation = get_instrumentation()
+        super(PlaybackScheduler, self).__init__()
 
-            metric_position = tick_number % len(self._messages)
-            tick_message = self._messages[metric_position]
+    @property
+    def lock(self):
+        return self._lock
 
-            if tick_message is None:
-                continue
+    @property
+    def clock(self):
+        return self._clock
 
-            tick_message.channel = self._channel
-            self._outport.send(tick_message)
+    def _push(self, player):
+        # pylint: disable-msg=protected-access
+        if player._message_queue:
+            heapq.heappush(self._heap, (player._message_queue[0].time, next(self._order), player._version, player))
+        elif not player._allow_updates:
+            player._finished.set()
 
-            if tick_message.type == 'note_on':
-                sleeper.sleep(self._duration)
-                end_tick_message = Message('note_off', note=tick_message.note, channel=self._channel)
-                self._outport.send(end_tick_message)
+    @concurrency.serialized
+    def schedule(self, player):
+        """(Re-)schedules the message queue of a player, after it has been started or updated."""
+        # pylint: disable-msg=protected-access
+        player._version += 1
+        self._push(player)
+        self._update_cv.notify()
 
-    def stop(self, stop_time=0, block=True):
-        self._stop_time = stop_time  # pylint: disable-msg=attribute-defined-outside-init
+    @concurrency.serialized
+    def run(self):
+        # pylint: disable-msg=protected-access
+        while not self._stop_signal.is_set():
+            now = self._clock.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now:
+                _, _, version, player = heapq.heappop(self._heap)
+                if version != player._version:
+                    continue
+                batch.extend((msg, player) for msg in player._pop_due_messages(now))
+                self._push(player)
+                if self._instrumentation is not None:
+                    self._instrumentation.record_count('playback_queue_depth', len(player._message_queue))
+            for msg, player in sorted(batch, key=lambda entry: entry[0].time):
+                if self._instrumentation is not None:
+                    self._instrumentation.record('playback_send_delay', self._clock.time() - msg.time)
+                player._outport.send(msg)
+            if batch and self._instrumentation is not None:
+                self._instrumentation.record_count('playback_batch_size', len(batch))
+                self._instrumentation.record('playback_lock_hold', self._clock.time() - now)
+
+            if self._heap:
+                self._update_cv.wait(timeout=self._clock.timeout(self._heap[0][0] - self._clock.time()))
+            else:
+                self._update_cv.wait()
+
+    def stop(self, block=True):
+        with self._lock:
+            self._stop_signal.set()
+            self._update_cv.notify()
         if block:
             self.join()
 
 
-class MidiPlayer(threading.Thread):
+class MidiPlayer():
+    """
+    A handle for playing back a sequence on a single channel.
+    The messages are sent by a PlaybackScheduler(), which may be shared with other players.
+    A sequence of None plays no notes.
+    """
 
-    def __init__(self, outport, sequence, start_time=time.time(),
-                 allow_updates=False, channel=0, offset=0.0):
+    def __init__(self, outport, sequence, start_time=None,
+                 allow_updates=False, channel=0, offset=0.0, scheduler=None):
         self._outport = outport
         self._channel = channel
         self._offset = offset
+        self._scheduler = PlaybackScheduler() if scheduler is None else scheduler
+        self._clock = self._scheduler.clock
 
         # Set of notes (pitches) that are currently on.
         self._open_notes = set()
-        # Lock for serialization.
-        self._lock = threading.RLock()
-        # A control variable to signal when the sequence has been updated.
-        self._update_cv = threading.Condition(self._lock)
+        # Lock for serialization, shared with the scheduler.
+        self._lock = self._scheduler.lock
         # The queue of mido.Message objects to send, sorted by ascending time.
-        self._message_queue = deque()
+        self._message_queue = SortedList(key=_message_key)
+        # Incremented by the scheduler whenever the message queue is replaced.
+        self._version = 0
         # An event that is set when `stop` has been called.
         self._stop_signal = threading.Event()
+        # Whether the player has been started and whether all of its messages have been sent for good.
+        self._started = False
+        self._finished = threading.Event()
 
         # Initialize message queue.
         # We first have to allow "updates" to set the initial sequence.
@@ -213,12 +532,10 @@ class MidiPlayer(threading.Thread):
         # We now make whether we allow updates dependent on the argument.
         self._allow_updates = allow_updates
 
-        super(MidiPlayer, self).__init__()
-
     @concurrency.serialized
     def update_sequence(self, sequence, start_time=None):
         if start_time is None:
-            start_time = time.time()
+            start_time = self._clock.time()
 
         if not self._allow_updates:
             raise MidiHubException(
@@ -228,7 +545,7 @@ class MidiPlayer(threading.Thread):
         # The set of pitches that are already playing and will be closed without
         # first being reopened in in the new sequence.
         closed_notes = set()
-        for note in sequence.notes:
+        for note in (sequence.notes if sequence is not None else ()):
             if note.start_time >= start_time:
                 new_message_list.append(
                     Message(type='note_on', note=note.pitch, velocity=note.velocity, time=note.start_time))
@@ -250,33 +567,94 @@ class MidiPlayer(threading.Thread):
             msg.channel = self._channel
             msg.time += self._offset
 
-        self._message_queue = deque(
-            sorted(new_message_list, key=lambda msg: (msg.time, msg.note)))
-        self._update_cv.notify()
+        self._message_queue = SortedList(new_message_list, key=_message_key)
+        if self._started:
+            self._scheduler.schedule(self)
 
     @concurrency.serialized
-    def run(self):
-        while self._message_queue and self._message_queue[0].time < time.time():
-            self._message_queue.popleft()
+    def splice_sequence(self, sequence, start_time=None, end_time=None):
+        """
+        Replaces the queued messages between 'start_time' and 'end_time' with the notes of 'sequence' that start
+        in that range, leaving the rest of the queue untouched. Without an 'end_time', the range is open-ended.
+        Notes that started before the range but would have ended within it are ended at 'start_time' instead.
+        """
+        if start_time is None:
+            start_time = self._clock.time()
+        if end_time is None:
+            end_time = float('inf')
 
-        while True:
-            while self._message_queue:
-                delta = self._message_queue[0].time - time.time()
-                if delta > 0:
-                    self._update_cv.wait(timeout=delta)
-                else:
-                    msg = self._message_queue.popleft()
-                    if msg.type == 'note_on':
-                        self._open_notes.add(msg.note)
-                    elif msg.type == 'note_off':
-                        self._open_notes.discard(msg.note)
-                    self._outport.send(msg)
-
-            # Either keep player alive and wait for sequence update, or return.
-            if self._allow_updates:
-                self._update_cv.wait()
+        if not self._allow_updates:
+            raise MidiHubException(
+                'Attempted to update a MidiPlayer sequence with updates disabled.')
+
+        # Remove the messages within the range.
+        first = self._message_queue.bisect_key_left((start_time + self._offset,))
+        last = self._message_queue.bisect_key_left((end_time + self._offset,))
+        removed_messages = self._message_queue[first:last]
+        del self._message_queue[first:last]
+
+        new_message_list = []
+        # Keep ending the notes that were started before the range.
+        removed_note_ons = defaultdict(int)
+        for msg in removed_messages:
+            if msg.type == 'note_on':
+                removed_note_ons[msg.note] += 1
+            elif removed_note_ons[msg.note]:
+                removed_note_ons[msg.note] -= 1
             else:
+                new_message_list.append(msg.copy(time=start_time + self._offset))
+        # Drop the note offs after the range that belong to removed note ons.
+        orphaned_note_offs = []
+        for msg in self._message_queue.islice(first):
+            if not any(removed_note_ons.values()):
                 break
+            if msg.type == 'note_off' and removed_note_ons[msg.note]:
+                removed_note_ons[msg.note] -= 1
+                orphaned_note_offs.append(msg)
+        for msg in orphaned_note_offs:
+            self._message_queue.remove(msg)
+
+        for note in sequence.notes:
+            if start_time <= note.start_time < end_time:
+                new_message_list.append(Message(type='note_on', note=note.pitch, velocity=note.velocity,
+                                                channel=self._channel, time=note.start_time + self._offset))
+                new_message_list.append(Message(type='note_off', note=note.pitch, channel=self._channel,
+                                                time=note.end_time + self._offset))
+
+        self._message_queue.update(new_message_list)
+        if self._started:
+            self._scheduler.schedule(self)
+
+    def _pop_due_messages(self, now):
+        """Removes and returns all queued messages that are due at 'now', keeping track of open notes."""
+        due_messages = []
+        while self._message_queue and self._message_queue[0].time <= now:
+            msg = self._message_queue.pop(0)
+            if msg.type == 'note_on':
+                self._open_notes.add(msg.note)
+            elif msg.type == 'note_off':
+                self._open_notes.discard(msg.note)
+            due_messages.append(msg)
+        return due_messages
+
+    @concurrency.serialized
+    def start(self):
+        if self._started:
+            raise RuntimeError('MidiPlayer can only be started once.')
+        while self._message_queue and self._message_queue[0].time < self._clock.time():
+            self._message_queue.pop(0)
+        self._started = True
+        if not self._scheduler.is_alive():
+            self._scheduler.start()
+        self._scheduler.schedule(self)
+
+    def is_alive(self):
+        return self._started and not self._finished.is_set()
+
+    def join(self, timeout=None):
+        if not self._started:
+            raise RuntimeError('Cannot join MidiPlayer before it is started.')
+        self._finished.wait(timeout)
 
     def stop(self, block=True):
         with self._lock:
@@ -287,8 +665,127 @@ class MidiPlayer(threading.Thread):
                 # Replace message queue with immediate end of open notes.
                 self._message_queue.clear()
                 for note in self._open_notes:
-                    self._message_queue.append(Message(type='note_off', note=note, time=time.time()))
-                self._update_cv.notify()
+                    self._message_queue.add(Message(type='note_off', note=note, time=self._clock.time()))
+                if self._started:
+                    self._scheduler.schedule(self)
+        if block:
+            self.join()
+
+
+class Metronome(MidiPlayer):
+    """
+    Plays metronome ticks through a PlaybackScheduler(), like a sequence that is extended as it is played.
+    The ticks of the next bar are queued before the current bar ends, so the metronome needs no thread of
+    its own. Updates take effect at the next bar boundary.
+    """
+
+    def __init__(self, outport, qpm, start_time, stop_time=None, program=_DEFAULT_METRONOME_PROGRAM,
+                 signals=None, duration=_DEFAULT_METRONOME_TICK_DURATION, channel=None, clock=DEFAULT_CLOCK,
+                 scheduler=None):
+        self._program = None
+        # Queued ticks as (time, tick number, messages) tuples, until they have started.
+        self._queued_ticks = deque()
+        # The time and number of the next tick to queue.
+        self._next_tick_time = None
+        self._next_tick_number = 0
+        # The time and number of the tick from which the tick times are counted.
+        self._anchor_time = None
+        self._anchor_number = 0
+        super(Metronome, self).__init__(outport, None, allow_updates=True,
+                                        scheduler=PlaybackScheduler(clock) if scheduler is None else scheduler)
+        self.update(qpm, start_time, stop_time, program, signals, duration, channel)
+
+    @property
+    def _bar_duration(self):
+        return self._period * len(self._messages)
+
+    def _restart(self, tick_time, tick_number):
+        self._anchor_time = self._next_tick_time = tick_time
+        self._anchor_number = self._next_tick_number = tick_number
+
+    def _drop_ticks(self, keep):
+        """Removes the latest queued ticks, as long as 'keep' returns False for their time."""
+        while self._queued_ticks and not keep(self._queued_ticks[-1][0]):
+            for msg in self._queued_ticks.pop()[2]:
+                self._message_queue.remove(msg)
+
+    def _queue_bar(self):
+        """Queues the ticks from the next tick up to the next bar boundary."""
+        while self._stop_time is None or self._next_tick_time <= self._stop_time:
+            tick_time, tick_number = self._next_tick_time, self._next_tick_number
+            tick_messages = []
+            tick_message = self._messages[tick_number % len(self._messages)]
+            if tick_message is not None:
+                tick_messages.append(tick_message.copy(channel=self._channel, time=tick_time))
+                if tick_message.type == 'note_on':
+                    tick_messages.append(Message('note_off', note=tick_message.note, channel=self._channel,
+                                                 time=tick_time + self._duration))
+            self._message_queue.update(tick_messages)
+            self._queued_ticks.append((tick_time, tick_number, tick_messages))
+            # Count from the anchor instead of summing up periods, so that the ticks do not drift.
+            self._next_tick_number += 1
+            self._next_tick_time = (self._anchor_time +
+                                    (self._next_tick_number - self._anchor_number) * self._period)
+            if self._next_tick_number % len(self._messages) == 0:
+                break
+
+    def _fill(self, now):
+        """
+        Queues bars until the ticks of the bar after the current one are queued.
+        If no tick is queued, e.g. because the metronome starts later, the next bar is queued however far ahead
+        it is, as the scheduler only wakes the metronome up for its queued messages.
+        """
+        while self._queued_ticks and self._queued_ticks[0][0] <= now:
+            self._queued_ticks.popleft()
+        while (self._allow_updates and (not self._queued_ticks or self._next_tick_time < now + self._bar_duration) and
+               (self._stop_time is None or self._next_tick_time <= self._stop_time)):
+            self._queue_bar()
+
+    def _pop_due_messages(self, now):
+        due_messages = super(Metronome, self)._pop_due_messages(now)
+        self._fill(now)
+        return due_messages
+
+    @concurrency.serialized
+    def update(self, qpm, start_time, stop_time=None, program=_DEFAULT_METRONOME_PROGRAM,
+               signals=None, duration=_DEFAULT_METRONOME_TICK_DURATION, channel=None):
+        channel = _DEFAULT_METRONOME_CHANNEL if channel is None else channel
+        if (program, channel) != (self._program, self._channel):
+            # Set the program number for the channels.
+            self._outport.send(Message(type='program_change', program=program, channel=channel))
+        self._program = program
+        self._channel = channel
+        messages_per_bar = None if self._anchor_time is None else len(self._messages)
+        self._period = 60. / qpm
+        self._stop_time = stop_time
+        self._messages = (_DEFAULT_METRONOME_MESSAGES if signals is None else
+                          [s.to_message() if s else None for s in signals])
+        self._duration = duration
+
+        # Requeue the ticks from the next bar boundary on with the new settings.
+        now = self._clock.time()
+        next_bar = next(((tick_time, tick_number) for tick_time, tick_number, _ in self._queued_ticks
+                         if tick_time > now and tick_number % messages_per_bar == 0), None)
+        if next_bar is not None:
+            self._drop_ticks(lambda tick_time: tick_time < next_bar[0])
+            self._restart(*next_bar)
+        if self._anchor_time is None or start_time > self._next_tick_time:
+            # Start counting ticks from 'start_time'.
+            self._drop_ticks(lambda tick_time: tick_time <= now)
+            tick_number = max(0, int((now - start_time) // self._period) + 1)
+            self._restart(start_time + tick_number * self._period, tick_number)
+        self._fill(now)
+        if self._started:
+            self._scheduler.schedule(self)
+
+    def stop(self, stop_time=0, block=True):
+        with self._lock:
+            self._stop_time = stop_time  # pylint: disable-msg=attribute-defined-outside-init
+            self._allow_updates = False
+            # Drop the ticks after the stop time, but let the sounding ones end.
+            self._drop_ticks(lambda tick_time: tick_time <= stop_time)
+            if self._started:
+                self._scheduler.schedule(self)
         if block:
             self.join()
 
@@ -298,23 +795,40 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
     # A message that is used to wake the consumer thread.
     _WAKE_MESSAGE = None
 
-    def __init__(self, qpm, start_time=0, stop_time=None, stop_signal=None):
+    def __init__(self, qpm, start_time=0, stop_time=None, stop_signal=None, clock=DEFAULT_CLOCK,
+                 callback_executor=None, stopped_callback=None, retention=None):
         # pylint: disable-msg=no-member
+        self._clock = clock
+        # Called with the captor once it has stopped capturing.
+        self._stopped_callback = stopped_callback
+        # An executor of its own is shut down once capture has ended, a shared one is left to its owner.
+        self._owns_callback_executor = callback_executor is None
+        self._callback_executor = (CallbackExecutor(max_workers=1, clock=clock) if callback_executor is None
+                                   else callback_executor)
         # A lock for synchronization.
         self._lock = threading.RLock()
         self._receive_queue = Queue()
-        self._captured_sequence = music_pb2.NoteSequence()
-        self._captured_sequence.tempos.add(qpm=qpm)
+        # The captured notes, from which NoteSequences are only built on demand.
+        self._notes = NoteBuffer()
+        self._qpm = qpm
+        # Seconds of notes kept before the latest captured note, or None to keep all notes since `start_time`.
+        self._retention = retention
+        # The time at which capture ended, once it has.
+        self._end_time = None
         self._start_time = start_time
         self._stop_time = stop_time
         self._stop_time_unsafe = None
-        self._stop_regex = re.compile(str(stop_signal))
-        # A set of active MidiSignals being used by iterators.
-        self._iter_signals = []
+        self._stop_midi_signal = stop_signal
+        # An index of the active MidiSignals being used by iterators, mapped to their queues.
+        self._iter_signals = SignalIndex()
         # An event that is set when `stop` has been called.
         self._stop_signal = threading.Event()
-        # Active callback threads keyed by unique thread name.
+        # Active callback threads or signal callbacks keyed by unique name.
         self._callbacks = {}
+        # An index of the MidiSignals of callbacks, mapped to (name, fn, inline) tuples.
+        self._signal_callbacks = SignalIndex()
+        # Records receive queue depths, if instrumentation is enabled.
+        self._instrumentation = get_instrumentation()
         super(MidiCaptor, self).__init__()
 
     @property
@@ -327,12 +841,18 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
     def start_time(self, value):
         # pylint: disable-msg=no-member
         self._start_time = value
-        i = 0
-        for note in self._captured_sequence.notes:
-            if note.start_time >= self._start_time:
-                break
-            i += 1
-        del self._captured_sequence.notes[:i]
+        self._notes.trim(self._start_time)
+
+    @property
+    def retention(self):
+        return self._retention
+
+    @concurrency.serialized
+    def window_start(self, end_time):
+        """Returns the start of the retained capture window that ends at 'end_time'."""
+        if self._retention is None:
+            return self._start_time
+        return max(self._start_time, end_time - self._retention)
 
     @property
     @concurrency.serialized
@@ -349,20 +869,18 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
             raise MidiHubException(
                 'MidiCaptor received message with empty time attribute: %s' % msg)
         self._receive_queue.put(msg)
+        if self._instrumentation is not None:
+            self._instrumentation.record_count('captor_queue_depth', self._receive_queue.qsize())
 
     @abc.abstractmethod
     def _capture_message(self, msg):
         pass
 
     def _add_note(self, msg):
-        """Adds and returns a new open note based on the MIDI message."""
-        # pylint: disable-msg=no-member
-        new_note = self._captured_sequence.notes.add()
-        new_note.start_time = msg.time
-        new_note.pitch = msg.note
-        new_note.velocity = msg.velocity
-        new_note.is_drum = (msg.channel == _DRUM_CHANNEL)
-        return new_note
+        """Adds a new open note based on the MIDI message and returns its index."""
+        if self._retention is not None:
+            self._notes.trim(msg.time - self._retention)
+        return self._notes.add(msg.time, msg.note, msg.velocity, msg.channel == _DRUM_CHANNEL)
 
     def run(self):
         """Captures incoming messages until stop time or signal received."""
@@ -370,9 +888,10 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
             timeout = None
             stop_time = self._stop_time
             if stop_time is not None:
-                timeout = stop_time - time.time()
+                timeout = stop_time - self._clock.time()
                 if timeout <= 0:
                     break
+                timeout = self._clock.timeout(timeout)
             try:
                 msg = self._receive_queue.get(block=True, timeout=timeout)
             except Empty:
@@ -384,14 +903,17 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
             if msg.time <= self._start_time:
                 continue
 
-            if self._stop_regex.match(str(msg)) is not None:
+            if self._stop_midi_signal is not None and self._stop_midi_signal.matches(msg):
                 break
 
             with self._lock:
-                msg_str = str(msg)
-                for regex, queue in self._iter_signals:
-                    if regex.match(msg_str) is not None:
-                        queue.put(msg.copy())
+                for queue in self._iter_signals.matching(msg):
+                    queue.put(msg.copy())
+                callbacks = self._signal_callbacks.matching(msg)
+            if callbacks:
+                captured_sequence = self.captured_sequence(msg.time)
+                for name, fn, inline in callbacks:
+                    self._callback_executor.submit(fn, captured_sequence, inline=inline, key=name)
 
             self._capture_message(msg)
 
@@ -401,10 +923,18 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
         # Acquire lock to avoid race condition with `iterate`.
         with self._lock:
             # Set final captured sequence.
-            self._captured_sequence = self.captured_sequence(end_time)
+            self._end_time = end_time
             # Wake up all generators.
-            for regex, queue in self._iter_signals:
+            for queue in self._iter_signals.values():
                 queue.put(MidiCaptor._WAKE_MESSAGE)
+            callbacks = self._signal_callbacks.values()
+        # Call signal callbacks a final time with the complete sequence, like iterator callbacks.
+        for name, fn, inline in callbacks:
+            self._callback_executor.submit(fn, self.captured_sequence(end_time), inline=inline, key=name)
+        if self._owns_callback_executor:
+            self._callback_executor.shutdown()
+        if self._stopped_callback is not None:
+            self._stopped_callback(self)
 
     def stop(self, stop_time=None, block=True):
         with self._lock:
@@ -415,34 +945,35 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
                         'MidiCaptor.')
             else:
                 self._stop_signal.set()
-                self._stop_time = time.time() if stop_time is None else stop_time
+                self._stop_time = self._clock.time() if stop_time is None else stop_time
                 # Force the thread to wake since we've updated the stop time.
                 self._receive_queue.put(MidiCaptor._WAKE_MESSAGE)
         if block:
             self.join()
 
-    def captured_sequence(self, end_time=None):
+    def captured_sequence(self, end_time=None, start_time=None):
+        """
+        Builds a NoteSequence of the notes captured before 'end_time', ending notes that are still sounding then.
+        If 'start_time' is given, only the notes starting from then on are included. Otherwise the sequence
+        covers the retained capture window, so it has a fixed length if a retention is set.
+        """
         # pylint: disable-msg=no-member
-        # Make a copy of the sequence currently being captured.
-        current_captured_sequence = music_pb2.NoteSequence()
         with self._lock:
-            current_captured_sequence.CopyFrom(self._captured_sequence)
-
-        if self.is_alive():
-            if end_time is None:
+            if self.is_alive():
+                if end_time is None:
+                    raise MidiHubException(
+                        '`end_time` must be provided when capture thread is still running.')
+            elif end_time is not None:
                 raise MidiHubException(
-                    '`end_time` must be provided when capture thread is still running.')
-            for i, note in enumerate(current_captured_sequence.notes):
-                if note.start_time >= end_time:
-                    del current_captured_sequence.notes[i:]
-                    break
-                if not note.end_time or note.end_time > end_time:
-                    note.end_time = end_time
-            current_captured_sequence.total_time = end_time
-        elif end_time is not None:
-            raise MidiHubException(
-                '`end_time` must not be provided when capture is complete.')
+                    '`end_time` must not be provided when capture is complete.')
+            else:
+                end_time = self._end_time
+            if start_time is None and self._retention is not None and end_time is not None:
+                start_time = self.window_start(end_time)
+            notes = self._notes.window(end_time, start_time)
 
+        current_captured_sequence = notes.to_sequence()
+        current_captured_sequence.tempos.add(qpm=self._qpm)
         return current_captured_sequence
 
     def iterate(self, signal=None, period=None):
@@ -452,24 +983,22 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
                 'call.')
 
         if signal is None:
-            sleeper = concurrency.Sleeper()
-            next_yield_time = time.time() + period
+            next_yield_time = self._clock.time() + period
         else:
-            regex = re.compile(str(signal))
             queue = Queue()
             with self._lock:
-                self._iter_signals.append((regex, queue))
+                self._iter_signals.add(signal, queue)
 
         while self.is_alive():
             if signal is None:
-                skipped_periods = (time.time() - next_yield_time) // period
+                skipped_periods = (self._clock.time() - next_yield_time) // period
                 if skipped_periods > 0:
-                    tf.logging.warn(
+                    logging.warning(
                         'Skipping %d %.3fs period(s) to catch up on iteration.',
                         skipped_periods, period)
                     next_yield_time += skipped_periods * period
                 else:
-                    sleeper.sleep_until(next_yield_time)
+                    self._clock.sleep_until(next_yield_time)
                 end_time = next_yield_time
                 next_yield_time += period
             else:
@@ -490,7 +1019,20 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
             yield captured_sequence
         yield self.captured_sequence()
 
-    def register_callback(self, fn, signal=None, period=None):
+    def register_callback(self, fn, signal=None, period=None, inline=False):
+        """
+        Calls 'fn' with the captured sequence whenever 'signal' is received or every 'period' seconds.
+        Signal callbacks run on the callback executor, or inline on the capture thread if 'inline' is set.
+        Returns a name for cancel_callback().
+        """
+        if signal is not None and period is None:
+            with self._lock:
+                name = 'SignalCallback-%d' % next(_CALLBACK_IDS)
+                callback = (name, fn, inline)
+                self._signal_callbacks.add(signal, callback)
+                self._callbacks[name] = callback
+            return name
+
         class IteratorCallback(threading.Thread):
             """A thread for executing a callback on each iteration."""
 
@@ -522,40 +1064,45 @@ class MidiCaptor(threading.Thread, metaclass=abc.ABCMeta):
 
     @concurrency.serialized
     def cancel_callback(self, name):
-        self._callbacks[name].stop()
-        del self._callbacks[name]
+        callback = self._callbacks.pop(name)
+        if isinstance(callback, threading.Thread):
+            callback.stop()
+        else:
+            self._signal_callbacks.remove(callback)
 
 
 class MonophonicMidiCaptor(MidiCaptor):
 
     def __init__(self, *args, **kwargs):
+        # The index and pitch of the open note.
         self._open_note = None
         super(MonophonicMidiCaptor, self).__init__(*args, **kwargs)
 
     @concurrency.serialized
     def _capture_message(self, msg):
         if msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-            if self._open_note is None or msg.note != self._open_note.pitch:
+            if self._open_note is None or msg.note != self._open_note[1]:
                 # This is not the note we're looking for. Drop it.
                 return
 
-            self._open_note.end_time = msg.time
+            self._notes.end_note(self._open_note[0], msg.time)
             self._open_note = None
 
         elif msg.type == 'note_on':
             if self._open_note:
-                if self._open_note.pitch == msg.note:
+                if self._open_note[1] == msg.note:
                     # This is just a repeat of the previous message.
                     return
                 # End the previous note.
-                self._open_note.end_time = msg.time
+                self._notes.end_note(self._open_note[0], msg.time)
 
-            self._open_note = self._add_note(msg)
+            self._open_note = (self._add_note(msg), msg.note)
 
 
 class PolyphonicMidiCaptor(MidiCaptor):
 
     def __init__(self, *args, **kwargs):
+        # The indices of the open notes keyed by pitch.
         self._open_notes = dict()
         super(PolyphonicMidiCaptor, self).__init__(*args, **kwargs)
 
@@ -566,44 +1113,54 @@ class PolyphonicMidiCaptor(MidiCaptor):
                 # This is not a note we're looking for. Drop it.
                 return
 
-            self._open_notes[msg.note].end_time = msg.time
-            del self._open_notes[msg.note]
+            self._notes.end_note(self._open_notes.pop(msg.note), msg.time)
 
         elif msg.type == 'note_on':
             if msg.note in self._open_notes:
                 # This is likely just a repeat of the previous message.
                 return
 
-            new_note = self._add_note(msg)
-            self._open_notes[new_note.pitch] = new_note
+            self._open_notes[msg.note] = self._add_note(msg)
 
 
 class MidiHub():
 
-    def __init__(self, input_midi_ports, output_midi_ports, texture_type, passthrough=True, playback_offset=0.0):
+    def __init__(self, input_midi_ports, output_midi_ports, texture_type, passthrough=True, playback_offset=0.0,
+                 clock=DEFAULT_CLOCK, callback_executor=None):
         self._texture_type = texture_type
+        # The clock that timestamps incoming messages and times capture and playback.
+        self._clock = clock
+        # Records lock wait and hold times, if instrumentation is enabled.
+        self._instrumentation = get_instrumentation()
         self._passthrough = passthrough
         self._playback_offset = playback_offset
         # When `passthrough` is True, this is the set of open MIDI note
         # pitches.
         self._open_notes = set()
-        # This lock is used by the serialized decorator.
+        # All methods take this lock through _timed_lock().
         self._lock = threading.RLock()
-        # A dictionary mapping a compiled MidiSignal regex to a condition variable
-        # that will be notified when a matching messsage is received.
-        self._signals = {}
-        # A dictionary mapping a compiled MidiSignal regex to a list of functions
-        # that will be called with the triggering message in individual threads when
-        # a matching message is received.
-        self._callbacks = defaultdict(list)
+        # An index mapping MidiSignals to a condition variable that will be
+        # notified when a matching messsage is received.
+        self._signals = SignalIndex()
+        # An index mapping MidiSignals to a list of (function, inline) pairs. The
+        # functions will be called with the triggering message on the callback
+        # executor, or inline, when a matching message is received.
+        self._callbacks = SignalIndex()
+        self._callback_executor = (CallbackExecutor(clock=clock) if callback_executor is None
+                                   else callback_executor)
         # A dictionary mapping integer control numbers to most recently-received
         # integer value.
         self._control_values = {}
-        # Threads actively being used to capture incoming messages.
-        self._captors = []
-        # Potentially active player threads.
+        # Threads actively being used to capture incoming messages. This is an
+        # immutable snapshot that is replaced whenever a captor starts or stops,
+        # so that messages can be fanned out to it without holding the lock.
+        self._captors = ()
+        # Potentially active players, all sent by a single scheduler thread.
         self._players = []
+        self._scheduler = None
         self._metronome = None
+        # Whether close() has been called.
+        self._closed = False
 
         # Open MIDI ports.
 
@@ -628,7 +1185,7 @@ class MidiHub():
 
         outports = []
         for port in output_midi_ports:
-            if isinstance(port, ports.BaseInput):
+            if isinstance(port, ports.BaseOutput):
                 outports.append(port)
             else:
                 virtual = port not in get_output_names()
@@ -639,61 +1196,112 @@ class MidiHub():
         self._outport = ports.MultiPort(outports)
 
     def __del__(self):
-        for captor in self._captors:
+        self.close()
+
+    def close(self):
+        """
+        Stops all captors, players and the metronome, then the scheduler thread and the callback executor.
+        The hub must be closed explicitly once it is no longer used, as its threads keep it alive.
+        """
+        with self._timed_lock():
+            if self._closed:
+                return
+            self._closed = True
+            captors = self._captors
+            players, self._players = self._players, []
+            scheduler, self._scheduler = self._scheduler, None
+        for captor in captors:
             captor.stop(block=False)
-        for player in self._players:
+        for player in players:
             player.stop(block=False)
         self.stop_metronome()
-        for captor in self._captors:
+        for captor in captors:
             captor.join()
-        for player in self._players:
+        for player in players:
             player.join()
+        if scheduler is not None:
+            scheduler.stop()
+        self._callback_executor.shutdown()
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def callback_executor(self):
+        return self._callback_executor
 
     @property
-    @concurrency.serialized
     def passthrough(self):
-        return self._passthrough
+        with self._timed_lock():
+            return self._passthrough
 
     @passthrough.setter
-    @concurrency.serialized
     def passthrough(self, value):
-        if self._passthrough == value:
+        with self._timed_lock():
+            if self._passthrough == value:
+                return
+            # Close all open notes.
+            while self._open_notes:
+                self._outport.send(Message('note_off', note=self._open_notes.pop()))
+            self._passthrough = value
+
+    @contextmanager
+    def _timed_lock(self):
+        """
+        Holds the hub lock, recording how long it took to acquire and how long it was held if instrumented.
+        Yields a function that waits on a condition of the lock; the time spent waiting is not counted as held.
+        """
+        if self._instrumentation is None:
+            with self._lock:
+                yield lambda cond_var: cond_var.wait()
             return
-        # Close all open notes.
-        while self._open_notes:
-            self._outport.send(Message('note_off', note=self._open_notes.pop()))
-        self._passthrough = value
+        requested = self._clock.time()
+        with self._lock:
+            acquired = self._clock.time()
+            self._instrumentation.record('hub_lock_wait', acquired - requested)
+            released = [0.0]
+
+            def wait(cond_var):
+                wait_started = self._clock.time()
+                cond_var.wait()
+                released[0] += self._clock.time() - wait_started
+
+            try:
+                yield wait
+            finally:
+                self._instrumentation.record('hub_lock_hold', self._clock.time() - acquired - released[0])
 
     def _timestamp_and_handle_message(self, msg):
         if msg.type == 'program_change':
             return
         if not msg.time:
-            msg.time = time.time()
+            msg.time = self._clock.time()
         self._handle_message(msg)
 
-    @concurrency.serialized
+        # Fan the message out to the capture threads outside of the lock. None of
+        # them modify it, so they all share a single frozen copy.
+        captors = self._captors
+        if captors:
+            shared_msg = freeze_message(msg)
+            for captor in captors:
+                captor.receive(shared_msg)
+
     def _handle_message(self, msg):
+        with self._timed_lock():
+            callbacks = self._dispatch_message(msg)
+        # Call any callbacks waiting for this message, outside of the lock as submitting may block while the
+        # callback queue is full.
+        for fn, inline in callbacks:
+            self._callback_executor.submit(fn, msg, inline=inline)
+
+    def _dispatch_message(self, msg):
+        """Handles a message and returns the (function, inline) pairs of the callbacks waiting for it."""
         # Notify any threads waiting for this message.
-        msg_str = str(msg)
-        for regex in list(self._signals):
-            if regex.match(msg_str) is not None:
-                self._signals[regex].notify_all()
-                del self._signals[regex]
-
-        # Call any callbacks waiting for this message.
-        for regex in list(self._callbacks):
-            if regex.match(msg_str) is not None:
-                for fn in self._callbacks[regex]:
-                    threading.Thread(target=fn, args=(msg,)).start()
-
-                del self._callbacks[regex]
-
-        # Remove any captors that are no longer alive.
-        self._captors[:] = [t for t in self._captors if t.is_alive()]
-        # Add a different copy of the message to the receive queue of each live
-        # capture thread.
-        for t in self._captors:
-            t.receive(msg.copy())
+        for cond_var in self._signals.pop_matching(msg):
+            cond_var.notify_all()
+
+        callbacks = [callback for fns in self._callbacks.pop_matching(msg) for callback in fns]
 
         # Update control values if this is a control change message.
         if msg.type == 'control_change':
@@ -726,17 +1334,24 @@ class MidiHub():
                     self._outport.send(Message('note_off', note=self._open_notes.pop()))
                 self._outport.send(msg)
                 self._open_notes.add(msg.note)
+        return callbacks
 
-    def start_capture(self, qpm, start_time, stop_time=None, stop_signal=None):
+    def start_capture(self, qpm, start_time, stop_time=None, stop_signal=None, retention=None):
         captor_class = (MonophonicMidiCaptor if
                         self._texture_type == TextureType.MONOPHONIC else
                         PolyphonicMidiCaptor)
-        captor = captor_class(qpm, start_time, stop_time, stop_signal)
-        with self._lock:
-            self._captors.append(captor)
+        captor = captor_class(qpm, start_time, stop_time, stop_signal, clock=self._clock,
+                              callback_executor=self._callback_executor, stopped_callback=self._remove_captor,
+                              retention=retention)
+        with self._timed_lock():
+            self._captors += (captor,)
         captor.start()
         return captor
 
+    def _remove_captor(self, captor):
+        with self._timed_lock():
+            self._captors = tuple(t for t in self._captors if t is not captor)
+
     def capture_sequence(self, qpm, start_time, stop_time=None, stop_signal=None):
         if stop_time is None and stop_signal is None:
             raise MidiHubException(
@@ -746,7 +1361,6 @@ class MidiHub():
         captor.join()
         return captor.captured_sequence()
 
-    @concurrency.serialized
     def wait_for_event(self, signal=None, timeout=None):
         if (signal, timeout).count(None) != 1:
             raise MidiHubException(
@@ -754,63 +1368,73 @@ class MidiHub():
                 '`wait_for_event` call.')
 
         if signal is None:
-            concurrency.Sleeper().sleep(timeout)
+            self._clock.sleep(timeout)
             return
 
-        signal_pattern = str(signal)
-        cond_var = None
-        for regex, cond_var in self._signals:
-            if regex.pattern == signal_pattern:
-                break
-        if cond_var is None:
-            cond_var = threading.Condition(self._lock)
-            self._signals[re.compile(signal_pattern)] = cond_var
+        with self._timed_lock() as wait:
+            cond_var = self._signals.get(signal)
+            if cond_var is None:
+                cond_var = threading.Condition(self._lock)
+                self._signals.add(signal, cond_var)
 
-        cond_var.wait()
+            wait(cond_var)
 
-    @concurrency.serialized
     def wake_signal_waiters(self, signal=None):
-        for regex in list(self._signals):
-            if signal is None or regex.pattern == str(signal):
-                self._signals[regex].notify_all()
-                del self._signals[regex]
-        for captor in self._captors:
-            captor.wake_signal_waiters(signal)
+        with self._timed_lock():
+            for cond_var in self._signals.pop(signal):
+                cond_var.notify_all()
+            for captor in self._captors:
+                captor.wake_signal_waiters(signal)
 
-    @concurrency.serialized
     def start_metronome(self, qpm, start_time, signals=None, channel=None):
-        if self._metronome is not None and self._metronome.is_alive():
-            self._metronome.update(
-                qpm, start_time, signals=signals, channel=channel)
-        else:
-            self._metronome = Metronome(
-                self._outport, qpm, start_time, signals=signals, channel=channel)
-            self._metronome.start()
+        scheduler = self._playback_scheduler()
+        with self._timed_lock():
+            if self._metronome is not None and self._metronome.is_alive():
+                self._metronome.update(
+                    qpm, start_time, signals=signals, channel=channel)
+            else:
+                self._metronome = Metronome(
+                    self._outport, qpm, start_time, signals=signals, channel=channel,
+                    scheduler=scheduler)
+                self._metronome.start()
 
-    @concurrency.serialized
     def stop_metronome(self, stop_time=0, block=True):
-        if self._metronome is None:
-            return
-        self._metronome.stop(stop_time, block)
-        self._metronome = None
-
-    def start_playback(self, sequence, playback_channel=0, start_time=time.time(), allow_updates=False):
-        player = MidiPlayer(self._outport, sequence, start_time,
-                            allow_updates, playback_channel, self._playback_offset)
-        with self._lock:
+        with self._timed_lock():
+            if self._metronome is None:
+                return
+            self._metronome.stop(stop_time, block)
+            self._metronome = None
+
+    def _playback_scheduler(self):
+        """Returns the scheduler that sends the messages of all players, starting it on first use."""
+        with self._timed_lock():
+            if self._scheduler is None:
+                self._scheduler = PlaybackScheduler(self._clock)
+                self._scheduler.start()
+            return self._scheduler
+
+    def start_playback(self, sequence, playback_channel=0, start_time=None, allow_updates=False):
+        scheduler = self._playback_scheduler()
+        with self._timed_lock():
+            player = MidiPlayer(self._outport, sequence, start_time, allow_updates,
+                                playback_channel, self._playback_offset, scheduler)
             self._players.append(player)
         player.start()
         return player
 
-    @concurrency.serialized
     def control_value(self, control_number):
         if control_number is None:
             return None
-        return self._control_values.get(control_number)
+        with self._timed_lock():
+            return self._control_values.get(control_number)
 
     def send_control_change(self, control_number, value):
         self._outport.send(Message(type='control_change', control=control_number, value=value))
 
-    @concurrency.serialized
-    def register_callback(self, fn, signal):
-        self._callbacks[re.compile(str(signal))].append(fn)
+    def register_callback(self, fn, signal, inline=False):
+        with self._timed_lock():
+            fns = self._callbacks.get(signal)
+            if fns is None:
+                self._callbacks.add(signal, [(fn, inline)])
+            else:
+                fns.append((fn, inline))
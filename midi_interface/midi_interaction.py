@@ -14,39 +14,16 @@
 
 ### System ###
 import logging
-from time import time
 from enum import Enum
-from sys import getsizeof
-from collections import namedtuple
 from threading import Thread, Event
 from abc import ABCMeta, abstractmethod
 
-### Magenta ###
-from magenta.music import trim_note_sequence
-from magenta.protobuf.music_pb2 import NoteSequence
-from magenta.music.testing_lib import add_track_to_sequence
-from magenta.protobuf.generator_pb2 import GeneratorOptions
-
 ### Local ###
-from settings import HARMONIZER_INPUT_NAME
-from midi_interface import MidiHub, TextureType
-
-Note = namedtuple("Note", ["pitch", "velocity", "start", "end"])
-
-
-def adjust_sequence_times(sequence, delta_time):
-    # pylint: disable-msg=no-member
-    retimed_sequence = NoteSequence()
-    retimed_sequence.CopyFrom(sequence)
-    for note in retimed_sequence.notes:
-        note.start_time += delta_time
-        note.end_time += delta_time
-    retimed_sequence.total_time += delta_time
-    return retimed_sequence
-
-
-def generate_midi_chord(notes, start_time, duration=2, velocity=80):
-    return [Note(note, velocity, start_time, duration) for note in notes]
+from settings import HARMONIZER_INPUT_NAME, PART_CACHE_SIZE, CAPTURE_RETENTION_BARS
+from midi_interface import MidiHub, TextureType, protobuf
+from midi_interface.clock import DEFAULT_CLOCK
+from midi_interface.note_array import NoteArray
+from midi_interface.part_generator import GeneratorService, PartGenerator, PartCache, MELODY, BASS, DRUMS
 
 
 class State(Enum):
@@ -55,13 +32,6 @@ class State(Enum):
     RESPONDING = 2
 
 
-class CacheItem():
-
-    def __init__(self, sequence, response_start_time):
-        self.sequence = sequence
-        self.response_start_time = response_start_time
-
-
 class MidiInteraction(Thread, metaclass=ABCMeta):
 
     _BASE_QPM = 60  # Base QPM when set by a tempo control change.
@@ -70,6 +40,7 @@ class MidiInteraction(Thread, metaclass=ABCMeta):
                  qpm, generator_select_control_number=None,
                  tempo_control_number=None, temperature_control_number=None):
         self._midi_hub = midi_hub
+        self._clock = midi_hub.clock
         self._sequence_generators = sequence_generators
         self._default_qpm = qpm
         self._generator_select_control_number = generator_select_control_number
@@ -113,9 +84,6 @@ class MidiInteraction(Thread, metaclass=ABCMeta):
 
 class SongStructureMidiInteraction(MidiInteraction):
     STRUCTURE = []
-    MELODY_CACHE = {}
-    BASS_CACHE = {}
-    DRUM_CACHE = {}
 
     def __init__(self, sequence_generators, qpm, structure,
                  generator_select_control_number=None, clock_signal=None, tick_duration=None,
@@ -123,17 +91,18 @@ class SongStructureMidiInteraction(MidiInteraction):
                  metronome_channel=None, min_listen_ticks_control_number=None,
                  max_listen_ticks_control_number=None, response_ticks_control_number=None,
                  tempo_control_number=None, temperature_control_number=None,
-                 loop_control_number=None, state_control_number=None):
-        midi_hub = MidiHub(None, [HARMONIZER_INPUT_NAME], TextureType.POLYPHONIC)
+                 loop_control_number=None, state_control_number=None, concurrent_generation=False,
+                 sequence_cache=None, generator_service=None, part_cache_size=PART_CACHE_SIZE,
+                 capture_retention_bars=CAPTURE_RETENTION_BARS, output_port=HARMONIZER_INPUT_NAME, clock=DEFAULT_CLOCK):
+        midi_hub = MidiHub(None, [output_port], TextureType.POLYPHONIC, clock=clock)
         super(SongStructureMidiInteraction, self).__init__(midi_hub, sequence_generators, qpm,
                                                            generator_select_control_number, tempo_control_number,
                                                            temperature_control_number)
         if [clock_signal, tick_duration].count(None) != 1:
             raise ValueError("Exactly one of 'clock_signal' or 'tick_duration' must be specified.")
         self.STRUCTURE = structure
-        self.MELODY_CACHE = {part.name: None for part in self.STRUCTURE}
-        self.BASS_CACHE = {part.name: None for part in self.STRUCTURE}
-        self.DRUM_CACHE = {part.name: None for part in self.STRUCTURE}
+        self._part_cache = PartCache(part_cache_size)
+        self._capture_retention_bars = capture_retention_bars
         self._clock_signal = clock_signal
         self._tick_duration = tick_duration
         self._end_call_signal = end_call_signal
@@ -146,6 +115,9 @@ class SongStructureMidiInteraction(MidiInteraction):
         self._response_ticks_control_number = response_ticks_control_number
         self._loop_control_number = loop_control_number
         self._state_control_number = state_control_number
+        self._concurrent_generation = concurrent_generation
+        self._sequence_cache = sequence_cache
+        self._generator_service = generator_service
         self._captor = None
         # Event for signalling when to end a call.
         self._end_call = Event()
@@ -181,6 +153,24 @@ class SongStructureMidiInteraction(MidiInteraction):
         val = self._midi_hub.control_value(self._max_listen_ticks_control_number)
         return float("inf") if not val else val
 
+    @property
+    def _capture_retention(self):
+        """The number of seconds of captured input to keep as primer, or None to keep all of it."""
+        if self._capture_retention_bars is None:
+            return None
+        bar_duration = self._tick_duration if self._tick_duration is not None else 4 * 60.0 / self._qpm
+        return self._capture_retention_bars * bar_duration
+
+    @property
+    def duration(self):
+        """
+        The number of seconds from the start of the interaction until the song has been played, or None if the
+        ticks come from a clock signal. The first part only starts at the first tick, one tick after the start.
+        """
+        if self._tick_duration is None:
+            return None
+        return (self.STRUCTURE.duration(bars=True) + 1) * self._tick_duration
+
     @property
     def _should_loop(self):
         return self._loop_control_number and self._midi_hub.control_value(self._loop_control_number) == 127
@@ -191,51 +181,65 @@ class SongStructureMidiInteraction(MidiInteraction):
         self._midi_hub.stop_metronome()
         super(SongStructureMidiInteraction, self).stop()
 
-    def _generate(self, gen_index, input_sequence, zero_time, response_start_time, response_end_time):
-        # pylint: disable-msg=no-member
-        response_start_time -= zero_time
-        response_end_time -= zero_time
-
-        generator_options = GeneratorOptions()
-        generator_options.input_sections.add(start_time=0, end_time=response_start_time)
-        generator_options.generate_sections.add(start_time=response_start_time, end_time=response_end_time)
-
-        # Set current temperature setting.
-        generator_options.args["temperature"].float_value = self._temperature
-
-        # Generate response.
-        generator = self._sequence_generators[gen_index]
-        logging.warn("Generating sequence using '{}' generator.".format(generator.details.id))
-        # logging.warn("\tGenerator Details:\t{}".format(generator.details))
-        # logging.warn("\tBundle Details:\t{}".format(generator.bundle_details))
-        # logging.warn("\tGenerator Options:\t{}".format(generator_options))
-        response_sequence = generator.generate(adjust_sequence_times(input_sequence, -zero_time), generator_options)
-        response_sequence = trim_note_sequence(response_sequence, response_start_time, response_end_time)
-        return adjust_sequence_times(response_sequence, zero_time)
+    def _prefetch_part(self, part_generator, part, input_sequence, zero_time, response_start_time,
+                       response_duration):
+        """Starts generating a part in the background, unless it is already cached or being generated."""
+        if part.name in self._part_cache or part_generator.pending(part.name):
+            return
+        logging.info("Scheduling generation of part '{}'".format(part.name))
+        part_generator.submit(part, input_sequence, zero_time, response_start_time,
+                              response_start_time + response_duration, self._temperature,
+                              song_digest=self.STRUCTURE.digest())
+
+    def _collect_part(self, part_generator, part):
+        """
+        Waits for a part to finish generating in the background and moves its sequences into the cache.
+        Returns its (melody, bass, drums) CacheItem()s.
+        """
+        logging.info("Waiting for generation of part '{}'".format(part.name))
+        items = part_generator.result(part.name)
+        for voice, item in enumerate(items):
+            self._part_cache.put(part.name, voice, item)
+        return items
+
+    def _next_uncached_part(self, part_generator, part_in_song):
+        """Returns the first upcoming part that is neither cached nor being generated, if there is one."""
+        for part in self.STRUCTURE[part_in_song + 1:]:
+            if part.name not in self._part_cache and not part_generator.pending(part.name):
+                return part
+        return None
 
     def run(self):
-        start_time = time()
-        self._captor = self._midi_hub.start_capture(self._qpm, start_time)
-
+        start_time = self._clock.time()
+        self._captor = self._midi_hub.start_capture(self._qpm, start_time, retention=self._capture_retention)
+        try:
+            self._play(start_time)
+        finally:
+            # The captor and the playback threads keep the hub alive, so they have to be stopped explicitly.
+            self._captor.stop()
+            self._midi_hub.close()
+
+    def _play(self, start_time):
+        """Plays the song part by part at each tick, from 'start_time' on."""
         if not self._clock_signal and self._metronome_channel is not None:
             self._midi_hub.start_metronome(self._qpm, start_time, channel=self._metronome_channel)
 
-        # Register callbacks
+        # Register callbacks. They only set events, so they can run inline on the capture thread.
         if self._end_call_signal is not None:
-            self._captor.register_callback(self._end_call_callback, signal=self._end_call_signal)
+            self._captor.register_callback(self._end_call_callback, signal=self._end_call_signal, inline=True)
         if self._panic_signal is not None:
-            self._captor.register_callback(self._panic_callback, signal=self._panic_signal)
+            self._captor.register_callback(self._panic_callback, signal=self._panic_signal, inline=True)
         if self._mutate_signal is not None:
-            self._captor.register_callback(self._mutate_callback, signal=self._mutate_signal)
+            self._captor.register_callback(self._mutate_callback, signal=self._mutate_signal, inline=True)
 
         # Keep track of the end of the previous tick time.
-        last_tick_time = time()
+        last_tick_time = self._clock.time()
 
         # Keep track of the duration of a listen state.
         listen_ticks = 0
 
         # Start with an empty response sequence.
-        response_sequence = NoteSequence()
+        response_sequence = protobuf.NoteSequence()
         response_start_time = 0
         response_duration = 0
 
@@ -245,6 +249,14 @@ class SongStructureMidiInteraction(MidiInteraction):
         player_chords = self._midi_hub.start_playback(response_sequence, playback_channel=3, allow_updates=True)
         player_drums = self._midi_hub.start_playback(response_sequence, playback_channel=9, allow_updates=True)
 
+        # Generates upcoming parts in the background while the current part is playing.
+        # Without a shared service, the interaction runs generators of its own.
+        service = self._generator_service
+        if service is None:
+            service = GeneratorService(self._sequence_generators, concurrent=self._concurrent_generation,
+                                       cache=self._sequence_cache)
+        part_generator = PartGenerator(service)
+
         # Song structure data
         part_in_song = 0  # index to STRUCTURE list
         bars_played = 0  # absolute number of bars played
@@ -252,12 +264,18 @@ class SongStructureMidiInteraction(MidiInteraction):
         total_bars = self.STRUCTURE.duration(bars=True)
         part_duration = self.STRUCTURE[part_in_song].duration(bars=True)
 
+        # Start generating the first part while waiting for the first tick.
+        if self._tick_duration is not None:
+            self._prefetch_part(part_generator, self.STRUCTURE[part_in_song],
+                                self._captor.captured_sequence(start_time), start_time,
+                                start_time + self._tick_duration, part_duration * self._tick_duration)
+
         # Enter loop at each clock tick.
         for captured_sequence in self._captor.iterate(signal=self._clock_signal, period=self._tick_duration):
             if self._stop_signal.is_set():
                 break
             if self._panic.is_set():
-                response_sequence = NoteSequence()
+                response_sequence = protobuf.NoteSequence()
                 player_melody.update_sequence(response_sequence)
                 player_bass.update_sequence(response_sequence)
                 player_chords.update_sequence(response_sequence)
@@ -273,7 +291,7 @@ class SongStructureMidiInteraction(MidiInteraction):
 
             tick_duration = tick_time - last_tick_time
 
-            if bars_played_for_part > part_duration:
+            if bars_played_for_part >= part_duration:
                 part_in_song += 1
                 bars_played_for_part = 0
             if part_in_song >= len(self.STRUCTURE):
@@ -289,7 +307,7 @@ class SongStructureMidiInteraction(MidiInteraction):
                                                                                                    total_bars))
 
             response_start_time = tick_time
-            capture_start_time = self._captor.start_time
+            capture_start_time = self._captor.window_start(tick_time)
             response_duration = part_duration * tick_duration
 
             last_tick_time = tick_time
@@ -300,67 +318,56 @@ class SongStructureMidiInteraction(MidiInteraction):
             if not start_of_part:
                 continue
 
-            if self.MELODY_CACHE[part.name]:
-                logging.info("Pulling melody sequence from cache")
-                melody_sequence = self.MELODY_CACHE[part.name].sequence
-                response_start_time = self.MELODY_CACHE[part.name].response_start_time
-            else:
-                logging.info("Generating new melody sequence")
-                melody_sequence = self._generate(0, captured_sequence, capture_start_time,
-                                                 response_start_time, response_start_time + response_duration)
-                self.MELODY_CACHE[part.name] = CacheItem(melody_sequence, capture_start_time)
-
-            if self.BASS_CACHE[part.name]:
-                logging.info("Pulling bass sequence from cache")
-                bass_sequence = self.BASS_CACHE[part.name].sequence
-                response_start_time = self.BASS_CACHE[part.name].response_start_time
+            items = [self._part_cache.get(part.name, voice) for voice in (MELODY, BASS, DRUMS)]
+            if None not in items:
+                logging.info("Pulling sequences for part '{}' from cache".format(part.name))
             else:
-                logging.info("Generating new bass sequence")
-                bass_sequence = self._generate(1, captured_sequence, capture_start_time,
-                                               response_start_time, response_start_time + response_duration)
-                self.BASS_CACHE[part.name] = CacheItem(bass_sequence, capture_start_time)
-
-            if self.DRUM_CACHE[part.name]:
-                logging.info("Pulling drum sequence from cache")
-                drum_sequence = self.DRUM_CACHE[part.name].sequence
-                response_start_time = self.DRUM_CACHE[part.name].response_start_time
-            else:
-                logging.info("Generating new drum sequence")
-                drum_sequence = self._generate(2, captured_sequence, capture_start_time,
-                                               response_start_time, response_start_time + response_duration)
-                self.DRUM_CACHE[part.name] = CacheItem(drum_sequence, capture_start_time)
-
-            size = getsizeof(self.MELODY_CACHE) + getsizeof(self.BASS_CACHE) + getsizeof(self.DRUM_CACHE)
-            logging.info("Cache Size: {}KB".format(size // 8))
-
-            chord_sequence, notes = NoteSequence(), []
-            chords = part.get_midi_chords()
-            for i, chord in enumerate(chords):
-                for note in generate_midi_chord(chord, i / 2, 0.5):
-                    notes.append(note)
-            notes = [Note(note.pitch, note.velocity, note.start + response_start_time,
-                          note.start + note.end + response_start_time) for note in notes]
-            add_track_to_sequence(chord_sequence, 0, notes)
+                # Only blocks if the look-ahead could not finish generating this part in time.
+                self._prefetch_part(part_generator, part, captured_sequence, capture_start_time,
+                                    response_start_time, response_duration)
+                items = self._collect_part(part_generator, part)
+
+            # Generate the next part that is not cached yet while this part is playing. Its primer is the window
+            # that ends when the part starts, as if it was generated in time. The input captured until then is not
+            # known yet though, so parts are only generated ahead while there is no captured input to respond to.
+            next_part = None if captured_sequence.notes else self._next_uncached_part(part_generator, part_in_song)
+            if next_part is not None:
+                next_part_start_time = response_start_time + response_duration
+                self._prefetch_part(part_generator, next_part, captured_sequence,
+                                    self._captor.window_start(next_part_start_time), next_part_start_time,
+                                    next_part.duration(bars=True) * tick_duration)
+
+            melody_notes = items[MELODY].notes_at(response_start_time)
+            bass_notes = items[BASS].notes_at(response_start_time)
+            drum_notes = items[DRUMS].notes_at(response_start_time)
+
+            logging.info("Cache Size: {}KB in {} entries | {}".format(
+                self._part_cache.size() // 1024, len(self._part_cache),
+                " | ".join("{}: {hits} hits, {misses} misses, {evictions} evictions".format(name, **stats)
+                           for name, stats in self._part_cache.stats().items())))
+
+            chord_notes = NoteArray.from_chords(self.STRUCTURE.chord_table(part), response_start_time, 0.5)
 
             # If it took too long to generate, push the response to next tick.
-            if (time() - response_start_time) >= tick_duration / 4:
-                push_ticks = ((time() - response_start_time) // tick_duration + 1)
+            if (self._clock.time() - response_start_time) >= tick_duration / 4:
+                push_ticks = ((self._clock.time() - response_start_time) // tick_duration + 1)
                 response_start_time += push_ticks * tick_duration
-                melody_sequence = adjust_sequence_times(melody_sequence, push_ticks * tick_duration)
-                bass_sequence = adjust_sequence_times(bass_sequence, push_ticks * tick_duration)
-                chord_sequence = adjust_sequence_times(chord_sequence, push_ticks * tick_duration)
-                drum_sequence = adjust_sequence_times(drum_sequence, push_ticks * tick_duration)
-                self.MELODY_CACHE[part.name].response_start_time = response_start_time
-                self.BASS_CACHE[part.name].response_start_time = response_start_time
-                self.DRUM_CACHE[part.name].response_start_time = response_start_time
+                melody_notes = melody_notes.shift(push_ticks * tick_duration)
+                bass_notes = bass_notes.shift(push_ticks * tick_duration)
+                chord_notes = chord_notes.shift(push_ticks * tick_duration)
+                drum_notes = drum_notes.shift(push_ticks * tick_duration)
                 logging.warning("Response too late. Pushing back {} ticks.".format(push_ticks))
 
             # Start response playback. Specify start_time to avoid stripping initial events due to generation lag.
-            player_melody.update_sequence(melody_sequence, start_time=response_start_time)
-            player_bass.update_sequence(bass_sequence, start_time=response_start_time)
-            player_chords.update_sequence(chord_sequence, start_time=response_start_time)
-            player_drums.update_sequence(drum_sequence, start_time=response_start_time)
-
+            # Only the queue from the start of the response onwards is replaced, the rest keeps playing as is.
+            player_melody.splice_sequence(melody_notes.to_sequence(), start_time=response_start_time)
+            player_bass.splice_sequence(bass_notes.to_sequence(), start_time=response_start_time)
+            player_chords.splice_sequence(chord_notes.to_sequence(), start_time=response_start_time)
+            player_drums.splice_sequence(drum_notes.to_sequence(), start_time=response_start_time)
+
+        part_generator.cancel()
+        if service is not self._generator_service:
+            service.shutdown()
         player_melody.stop()
         player_bass.stop()
         player_chords.stop()
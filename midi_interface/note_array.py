@@ -0,0 +1,192 @@
+"""
+A columnar representation of notes, for retiming and cutting sequences without walking protobufs in Python.
+"""
+
+### Numpy ###
+import numpy as np
+
+### Local ###
+from . import protobuf
+
+
+class NoteArray():
+    """
+    Stores the notes of a NoteSequence() as one NumPy array per attribute, sorted by start time.
+    All operations return new NoteArray()s and leave the original untouched.
+    """
+
+    def __init__(self, start_times=(), end_times=(), pitches=(), velocities=(), instruments=(), is_drum=(),
+                 total_time=0.0):
+        self.start_times = np.asarray(start_times, dtype=np.float64)
+        self.end_times = np.asarray(end_times, dtype=np.float64)
+        self.pitches = np.asarray(pitches, dtype=np.int16)
+        self.velocities = np.asarray(velocities, dtype=np.int16)
+        self.instruments = np.asarray(instruments, dtype=np.int16)
+        self.is_drum = np.asarray(is_drum, dtype=np.bool_)
+        self.total_time = float(total_time)
+
+    @classmethod
+    def from_sequence(cls, sequence):
+        """Converts the notes and the total time of a NoteSequence()."""
+        notes = sorted(sequence.notes, key=lambda note: note.start_time)
+        return cls([note.start_time for note in notes], [note.end_time for note in notes],
+                   [note.pitch for note in notes], [note.velocity for note in notes],
+                   [note.instrument for note in notes], [note.is_drum for note in notes], sequence.total_time)
+
+    @classmethod
+    def from_chords(cls, chord_table, start_time, duration, velocity=80):
+        """Plays every row of a compiled chord table (see SongPart.compile()) for 'duration' seconds each."""
+        rows, voices = np.nonzero(chord_table >= 0)
+        start_times = start_time + rows * duration
+        count = len(rows)
+        return cls(start_times, start_times + duration, chord_table[rows, voices], np.full(count, velocity),
+                   np.zeros(count), np.zeros(count), start_time + len(chord_table) * duration)
+
+    def to_sequence(self, tempos=None):
+        """Converts back into a NoteSequence(), optionally with the given tempos."""
+        # pylint: disable-msg=no-member
+        sequence = protobuf.NoteSequence()
+        if tempos:
+            sequence.tempos.extend(tempos)
+        for start_time, end_time, pitch, velocity, instrument, is_drum in zip(
+                self.start_times.tolist(), self.end_times.tolist(), self.pitches.tolist(),
+                self.velocities.tolist(), self.instruments.tolist(), self.is_drum.tolist()):
+            sequence.notes.add(start_time=start_time, end_time=end_time, pitch=pitch, velocity=velocity,
+                               instrument=instrument, is_drum=is_drum)
+        sequence.total_time = self.total_time
+        return sequence
+
+    def _select(self, mask, start_times=None, end_times=None, total_time=None):
+        return NoteArray(self.start_times[mask] if start_times is None else start_times,
+                         self.end_times[mask] if end_times is None else end_times,
+                         self.pitches[mask], self.velocities[mask], self.instruments[mask], self.is_drum[mask],
+                         self.total_time if total_time is None else total_time)
+
+    def shift(self, delta_time):
+        """Moves all notes and the total time by 'delta_time' seconds."""
+        if not delta_time:
+            return self
+        return NoteArray(self.start_times + delta_time, self.end_times + delta_time, self.pitches,
+                         self.velocities, self.instruments, self.is_drum, self.total_time + delta_time)
+
+    def trim(self, start_time, end_time):
+        """Keeps the notes starting within [start_time, end_time) and cuts them off at 'end_time'."""
+        mask = (self.start_times >= start_time) & (self.start_times < end_time)
+        return self._select(mask, end_times=np.minimum(self.end_times[mask], end_time),
+                            total_time=min(self.total_time, end_time))
+
+    def merge(self, other):
+        """Combines the notes of two arrays, keeping them sorted by start time."""
+        order = np.argsort(np.concatenate([self.start_times, other.start_times]), kind="mergesort")
+        return NoteArray(np.concatenate([self.start_times, other.start_times])[order],
+                         np.concatenate([self.end_times, other.end_times])[order],
+                         np.concatenate([self.pitches, other.pitches])[order],
+                         np.concatenate([self.velocities, other.velocities])[order],
+                         np.concatenate([self.instruments, other.instruments])[order],
+                         np.concatenate([self.is_drum, other.is_drum])[order],
+                         max(self.total_time, other.total_time))
+
+    @property
+    def nbytes(self):
+        """The number of bytes taken up by the note arrays."""
+        return sum(array.nbytes for array in (self.start_times, self.end_times, self.pitches, self.velocities,
+                                              self.instruments, self.is_drum))
+
+    def __len__(self):
+        return len(self.start_times)
+
+    def __repr__(self):
+        return "NoteArray(notes={}, total_time={})".format(len(self), self.total_time)
+
+
+class NoteBuffer():
+    """
+    Growable columnar storage for notes that are captured one at a time, in the order of their start times.
+    The columns are ring buffers: trimming the oldest notes only moves the head, and the columns double in size
+    when they are full, so adding and trimming notes take amortized constant time.
+    Notes are addressed by the index add() returns, which stays valid when earlier notes are trimmed.
+    Notes that are still sounding have an end time of NaN.
+    """
+
+    def __init__(self, capacity=256):
+        self._start_times = np.empty(capacity, dtype=np.float64)
+        self._end_times = np.empty(capacity, dtype=np.float64)
+        self._pitches = np.empty(capacity, dtype=np.int16)
+        self._velocities = np.empty(capacity, dtype=np.int16)
+        self._is_drum = np.empty(capacity, dtype=np.bool_)
+        # Position of the first stored note in the columns.
+        self._head = 0
+        self._size = 0
+        # Index of the first stored note, counting the notes that have been trimmed.
+        self._offset = 0
+
+    def _columns(self):
+        return [self._start_times, self._end_times, self._pitches, self._velocities, self._is_drum]
+
+    def _positions(self, first, last):
+        """Returns the column positions of the stored notes from 'first' up to 'last'."""
+        return (self._head + np.arange(first, last)) % len(self._start_times)
+
+    def _grow(self):
+        capacity = 2 * len(self._start_times)
+        positions = self._positions(0, self._size)
+        self._start_times, self._end_times, self._pitches, self._velocities, self._is_drum = [
+            np.concatenate([column[positions], np.empty(capacity - self._size, dtype=column.dtype)])
+            for column in self._columns()]
+        self._head = 0
+
+    def _search(self, time):
+        """Returns the number of stored notes that start before 'time'."""
+        capacity = len(self._start_times)
+        head_end = min(self._head + self._size, capacity)
+        count = int(np.searchsorted(self._start_times[self._head:head_end], time, side="left"))
+        if count == head_end - self._head:
+            # The stored notes wrap around, continue in the part at the start of the columns.
+            count += int(np.searchsorted(self._start_times[:self._size - count], time, side="left"))
+        return count
+
+    def add(self, start_time, pitch, velocity, is_drum=False):
+        """Adds a sounding note and returns its index."""
+        if self._size == len(self._start_times):
+            self._grow()
+        position = (self._head + self._size) % len(self._start_times)
+        self._start_times[position] = start_time
+        self._end_times[position] = np.nan
+        self._pitches[position] = pitch
+        self._velocities[position] = velocity
+        self._is_drum[position] = is_drum
+        self._size += 1
+        return self._offset + self._size - 1
+
+    def end_note(self, index, end_time):
+        """Ends the note with the given index, unless it has been trimmed already."""
+        position = index - self._offset
+        if 0 <= position < self._size:
+            self._end_times[(self._head + position) % len(self._start_times)] = end_time
+
+    def trim(self, start_time):
+        """Drops the notes that start before 'start_time'."""
+        count = self._search(start_time)
+        self._head = (self._head + count) % len(self._start_times)
+        self._size -= count
+        self._offset += count
+
+    def window(self, end_time=None, start_time=None):
+        """
+        Returns the notes that start within [start_time, end_time) as a NoteArray(), ending the notes that are
+        still sounding at 'end_time'. Without an 'end_time', all notes are returned and sounding notes end at 0.
+        """
+        first = 0 if start_time is None else self._search(start_time)
+        last = self._size if end_time is None else max(first, self._search(end_time))
+        positions = self._positions(first, last)
+        end_times = self._end_times[positions]
+        if end_time is None:
+            end_times[np.isnan(end_times)] = 0.0
+        else:
+            end_times[np.isnan(end_times) | (end_times > end_time)] = end_time
+        return NoteArray(self._start_times[positions], end_times, self._pitches[positions],
+                         self._velocities[positions], np.zeros(last - first), self._is_drum[positions],
+                         0.0 if end_time is None else end_time)
+
+    def __len__(self):
+        return self._size
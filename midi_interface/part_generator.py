@@ -0,0 +1,277 @@
+"""
+Generation of song parts on a background worker, ahead of their playback.
+"""
+
+### System ###
+import logging
+from time import time
+from threading import Lock, RLock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+### Numpy ###
+import numpy as np
+
+### Local ###
+from . import protobuf
+from .note_array import NoteArray
+from .sequence_cache import make_key, hash_sequence
+
+# Generator indices for each voice of a song part.
+MELODY, BASS, DRUMS = 0, 1, 2
+VOICE_NAMES = ["melody", "bass", "drums"]
+
+
+def generate_sequence(generator, input_sequence, zero_time, response_start_time, response_end_time,
+                      temperature=1.0):
+    """
+    Generates a response between the given absolute times, using 'input_sequence' as the primer.
+    Returns the notes of the response as a NoteArray().
+    """
+    # pylint: disable-msg=no-member
+    response_start_time -= zero_time
+    response_end_time -= zero_time
+
+    generator_options = protobuf.GeneratorOptions()
+    generator_options.input_sections.add(start_time=0, end_time=response_start_time)
+    generator_options.generate_sections.add(start_time=response_start_time, end_time=response_end_time)
+    generator_options.args["temperature"].float_value = temperature
+
+    logging.info("Generating sequence using '{}' generator.".format(generator.details.id))
+    primer_sequence = NoteArray.from_sequence(input_sequence).shift(-zero_time).to_sequence(input_sequence.tempos)
+    response_sequence = generator.generate(primer_sequence, generator_options)
+    return NoteArray.from_sequence(response_sequence).trim(response_start_time, response_end_time).shift(zero_time)
+
+
+def bundle_id(generator):
+    """Identifies the model a generator runs by its generator and bundle ids."""
+    bundle_details = generator.bundle_details
+    return "{}/{}".format(generator.details.id, bundle_details.id if bundle_details else "")
+
+
+class CacheItem():
+
+    def __init__(self, notes, response_start_time):
+        self.notes = notes
+        self.response_start_time = response_start_time
+
+    def notes_at(self, response_start_time):
+        """Returns the cached NoteArray() shifted to start at 'response_start_time'."""
+        return self.notes.shift(response_start_time - self.response_start_time)
+
+
+class PartCache():
+    """
+    Holds the generated CacheItem()s of song parts in memory, one entry per part and voice.
+    Once the notes of all entries exceed 'max_size' bytes, the least recently used entries are evicted.
+    Hits, misses and evictions are counted for each voice.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = RLock()
+        # CacheItem()s keyed by (part name, voice), ordered from least to most recently used.
+        self._entries = OrderedDict()
+        self._size = 0
+        self._stats = [{"hits": 0, "misses": 0, "evictions": 0} for _ in VOICE_NAMES]
+
+    def get(self, part_name, voice):
+        """Returns the CacheItem() of one voice of a part, or None if it is not cached."""
+        with self._lock:
+            item = self._entries.get((part_name, voice))
+            if item is None:
+                self._stats[voice]["misses"] += 1
+                return None
+            self._entries.move_to_end((part_name, voice))
+            self._stats[voice]["hits"] += 1
+            return item
+
+    def put(self, part_name, voice, item):
+        """Stores the CacheItem() of one voice of a part and evicts the least recently used entries if needed."""
+        with self._lock:
+            old_item = self._entries.pop((part_name, voice), None)
+            if old_item is not None:
+                self._size -= old_item.notes.nbytes
+            self._entries[(part_name, voice)] = item
+            self._size += item.notes.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and len(self._entries) > 1:
+            (part_name, voice), item = self._entries.popitem(last=False)
+            self._size -= item.notes.nbytes
+            self._stats[voice]["evictions"] += 1
+            logging.debug("Evicted {} of part '{}' from part cache".format(VOICE_NAMES[voice], part_name))
+
+    def __contains__(self, part_name):
+        """Returns whether all voices of a part are cached, without counting a hit or a miss."""
+        with self._lock:
+            return all((part_name, voice) in self._entries for voice in range(len(VOICE_NAMES)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        """Returns the number of bytes that the notes of all cached entries take up."""
+        return self._size
+
+    def stats(self):
+        """Returns copies of the hit, miss and eviction counters, keyed by voice name."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in zip(VOICE_NAMES, self._stats)}
+
+
+class GeneratorService():
+    """
+    Keeps initialized generators warm on long-lived workers and serves generation requests from any interaction.
+    In concurrent mode every generator gets a worker of its own, so the voices of a part are generated in parallel.
+    Either way, a single generator never runs more than one request at a time.
+    If a SequenceCache() is given, generated sequences are looked up there before running any inference.
+    Requests with a seed are sampled reproducibly, as long as the generators run one after another.
+    """
+
+    def __init__(self, sequence_generators, concurrent=False, cache=None):
+        self.sequence_generators = sequence_generators
+        self._cache = cache
+        # Guards the workers, so that no request is submitted while they are being switched.
+        self._lock = Lock()
+        self._executors = []
+        self._concurrent = None
+        self._closed = False
+        # Switches the workers in the background, one switch after another.
+        self._switcher = ThreadPoolExecutor(max_workers=1)
+        self._switch_executors(concurrent)
+
+    def set_concurrent(self, concurrent):
+        """
+        Switches between one worker per generator and a single worker shared by all of them.
+        Returns at once with a future of the switch, which happens once the old workers have finished their requests.
+        """
+        return self._switcher.submit(self._switch_executors, concurrent)
+
+    def _switch_executors(self, concurrent):
+        with self._lock:
+            if self._closed or concurrent == self._concurrent:
+                return
+            # Drain the old workers before the new ones take over, so that no generator is used by two workers at
+            # once. Requests submitted in the meantime wait for the new workers.
+            for executor in set(self._executors):
+                executor.shutdown(wait=True)
+            if concurrent:
+                self._executors = [ThreadPoolExecutor(max_workers=1) for _ in self.sequence_generators]
+            else:
+                self._executors = [ThreadPoolExecutor(max_workers=1)] * len(self.sequence_generators)
+            self._concurrent = concurrent
+
+    def warm_up(self, qpm=120):
+        """Runs a short inference on every generator, so that the first real request does not pay for lazy setup."""
+        # pylint: disable-msg=no-member
+        bar_duration = 4 * 60.0 / qpm
+        primer = protobuf.NoteSequence()
+        primer.tempos.add(qpm=qpm)
+        primer.total_time = bar_duration
+        started = time()
+        with self._lock:
+            futures = [self._executors[voice].submit(generate_sequence, generator, primer, 0, bar_duration,
+                                                     2 * bar_duration)
+                       for voice, generator in enumerate(self.sequence_generators)]
+        for future in futures:
+            future.result()
+        logging.info("Warmed up {} generators in {:.3f}s".format(len(futures), time() - started))
+
+    def _generate_voice(self, voice, part, input_sequence, zero_time, response_start_time, response_end_time,
+                        temperature, song_digest, seed):
+        generator = self.sequence_generators[voice]
+        started = time()
+        notes = None
+        if self._cache is not None:
+            # Cached sequences are stored relative to the start of their part.
+            key = make_key(song_digest, part.name, list(part), bundle_id(generator), temperature,
+                           hash_sequence(input_sequence, zero_time), round(response_start_time - zero_time, 3),
+                           round(response_end_time - response_start_time, 3), seed)
+            sequence = self._cache.get(key)
+            if sequence is not None:
+                logging.info("Loaded '{}' sequence for part '{}' from disk cache".format(generator.details.id,
+                                                                                       part.name))
+                notes = NoteArray.from_sequence(sequence).shift(response_start_time)
+        if notes is None:
+            if seed is not None:
+                # Seeded right before inference, so that the sampling does not depend on which requests were cached.
+                np.random.seed((seed + voice) % 2 ** 32)
+            notes = generate_sequence(generator, input_sequence, zero_time, response_start_time,
+                                      response_end_time, temperature)
+            if self._cache is not None:
+                self._cache.put(key, notes.shift(-response_start_time).to_sequence())
+        finished = time()
+        logging.info("Generated '{}' sequence for part '{}' in {:.3f}s".format(generator.details.id, part.name,
+                                                                            finished - started))
+        return CacheItem(notes, response_start_time), started, finished
+
+    def submit(self, voice, part, input_sequence, zero_time, response_start_time, response_end_time,
+               temperature=1.0, song_digest=None, seed=None):
+        """
+        Schedules the generation of one voice of a part on the worker of its generator.
+        If 'seed' is given, the voices of a part are sampled with seeds derived from it.
+        The future resolves to a CacheItem() and the times at which generation started and finished.
+        """
+        with self._lock:
+            return self._executors[voice].submit(self._generate_voice, voice, part, input_sequence, zero_time,
+                                                 response_start_time, response_end_time, temperature,
+                                                 song_digest, seed)
+
+    def shutdown(self):
+        """Releases the workers once all requests have finished."""
+        self._switcher.shutdown(wait=False)
+        with self._lock:
+            self._closed = True
+            for executor in set(self._executors):
+                executor.shutdown(wait=False)
+
+
+class PartGenerator():
+    """
+    Generates the melody, bass and drum sequences of song parts through a GeneratorService().
+    Parts are submitted ahead of time so that they are ready by the time their first bar arrives.
+    """
+
+    def __init__(self, service):
+        self._service = service
+        # Futures of parts that have been submitted but not yet collected, keyed by part name.
+        self._pending = {}
+
+    def submit(self, part, input_sequence, zero_time, response_start_time, response_end_time, temperature=1.0,
+               song_digest=None, seed=None):
+        """
+        Schedules the generation of 'part' on the background workers, unless it is already pending.
+        'song_digest' identifies the song the part belongs to in the sequence cache, 'seed' seeds its sampling.
+        Returns the futures of the melody, bass and drum sequences.
+        """
+        if part.name not in self._pending:
+            logging.info("Generating sequences for part '{}'".format(part.name))
+            self._pending[part.name] = [self._service.submit(voice, part, input_sequence, zero_time,
+                                                             response_start_time, response_end_time, temperature,
+                                                             song_digest, seed)
+                                        for voice in (MELODY, BASS, DRUMS)]
+        return self._pending[part.name]
+
+    def pending(self, part_name):
+        """Returns whether a part has been submitted but not yet collected."""
+        return part_name in self._pending
+
+    def result(self, part_name):
+        """Blocks until the given part has been generated and returns its (melody, bass, drums) CacheItem()s."""
+        return self.timed_result(part_name)[0]
+
+    def timed_result(self, part_name):
+        """Like result(), but also returns the wall-clock time in seconds that generating the part took."""
+        items, started, finished = zip(*[future.result() for future in self._pending.pop(part_name)])
+        elapsed = max(finished) - min(started)
+        logging.info("Generated part '{}' in {:.3f}s".format(part_name, elapsed))
+        return items, elapsed
+
+    def cancel(self):
+        """Cancels all parts that have not started generating yet, leaving the service running."""
+        for futures in self._pending.values():
+            for future in futures:
+                future.cancel()
+        self._pending.clear()
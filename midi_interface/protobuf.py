@@ -0,0 +1,22 @@
+"""
+Lazy access to the protobuf messages of Magenta.
+Importing any magenta module runs magenta/__init__.py, which imports TensorFlow. The messages are only imported
+when they are first used, e.g. protobuf.NoteSequence(), so that importing the application stays fast.
+"""
+
+### System ###
+from importlib import import_module
+
+# The modules providing each message, imported on first access.
+_MESSAGE_MODULES = {
+    "NoteSequence": "magenta.protobuf.music_pb2",
+    "GeneratorOptions": "magenta.protobuf.generator_pb2",
+}
+
+
+def __getattr__(name):
+    if name not in _MESSAGE_MODULES:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    message = getattr(import_module(_MESSAGE_MODULES[name]), name)
+    globals()[name] = message
+    return message
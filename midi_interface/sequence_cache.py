@@ -0,0 +1,135 @@
+"""
+A persistent, content-addressed cache for generated NoteSequence() objects.
+"""
+
+### System ###
+import os
+import logging
+import hashlib
+import tempfile
+from threading import RLock
+from collections import OrderedDict
+
+### Local ###
+from . import protobuf
+
+_EXTENSION = ".pb"
+
+# Fraction of the size budget that may be written before the directory is scanned again for the entries of
+# other processes.
+_RESCAN_FRACTION = 1 / 16
+
+
+def make_key(*components):
+    """Builds a cache key by hashing the string representations of all given components."""
+    digest = hashlib.sha1()
+    for component in components:
+        digest.update(repr(component).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def hash_sequence(sequence, zero_time=0):
+    """Hashes the tempo and the notes of a sequence, relative to 'zero_time'."""
+    # pylint: disable-msg=no-member
+    tempos = [round(tempo.qpm, 3) for tempo in sequence.tempos]
+    notes = [(note.pitch, note.velocity, note.is_drum, round(note.start_time - zero_time, 3),
+              round(note.end_time - zero_time, 3)) for note in sequence.notes]
+    return make_key(tempos, notes)
+
+
+class SequenceCache():
+    """
+    Stores NoteSequence() objects as serialized protobufs in a directory, one file per key.
+    Once the files exceed 'max_size' bytes, the least recently used entries are evicted.
+    Several processes can share a directory, e.g. the workers of a batch: entries written by other processes are
+    found on disk, and the directory is scanned again regularly so that the size budget holds for all of them,
+    give or take a fraction of it per process.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = RLock()
+        # Sizes of all cached files keyed by cache key, ordered from least to most recently used.
+        self._entries = OrderedDict()
+        self._size = 0
+        # Bytes written since the directory was last scanned.
+        self._unscanned = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+        logging.info("Opened sequence cache '{}' with {} entries ({}KB)".format(self.directory, len(self._entries),
+                                                                                self._size // 1024))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _EXTENSION)
+
+    def _scan(self):
+        """Indexes the files in the directory, including those written by other processes, by access time."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_EXTENSION):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # evicted by another process in the meantime
+                files.append((stat.st_mtime, entry.name[:-len(_EXTENSION)], stat.st_size))
+        with self._lock:
+            self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+            self._size = sum(self._entries.values())
+            self._unscanned = 0
+
+    def get(self, key):
+        """Returns the sequence stored under 'key', or None if it is not cached."""
+        # pylint: disable-msg=no-member
+        # Keys that are not indexed are looked up on disk too, another process may have stored them.
+        try:
+            with open(self._path(key), "rb") as file:
+                data = file.read()
+            # Touch the file so that the access order survives a restart.
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+        with self._lock:
+            # Re-insert the entry as the most recently used one.
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+        sequence = protobuf.NoteSequence()
+        sequence.ParseFromString(data)
+        return sequence
+
+    def put(self, key, sequence):
+        """Stores a sequence under 'key' and evicts the least recently used entries if the cache is too large."""
+        data = sequence.SerializeToString()
+        # A temporary file that is unique across processes, renamed into place so that readers never see a partial
+        # file.
+        handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(handle, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, self._path(key))
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._unscanned += len(data)
+            if self._size > self.max_size or self._unscanned > self.max_size * _RESCAN_FRACTION:
+                self._scan()
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            logging.debug("Evicted '{}' from sequence cache".format(key))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        """Returns the number of bytes that all cached sequences take up on disk."""
+        return self._size
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Rebuilds the MIDI file of a recording from its journal, e.g. after the application crashed while recording.
+"""
+
+### Logging ###
+import logging
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+
+### System ###
+import argparse
+
+### Local ###
+from settings import RECORDING_FILE
+from middleware.recorder import recover_recording, JOURNAL_SUFFIX
+
+
+def main(args):
+    journal_path = args.journal if args.journal else args.output + JOURNAL_SUFFIX
+    count = recover_recording(journal_path, args.output)
+    logging.info("Recovered {} events from '{}' into '{}'".format(count, journal_path, args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, dest="journal", default=None,
+                        metavar="file", help="The recording journal (default: the output file + '{}')".format(
+                            JOURNAL_SUFFIX))
+    parser.add_argument("-o", "--output", type=str, dest="output", default=RECORDING_FILE,
+                        metavar="file", help="The MIDI file to write (default: {})".format(RECORDING_FILE))
+    main(parser.parse_args())
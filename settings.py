@@ -5,9 +5,30 @@ Container class for global settings variables.
 ### UI ###
 UPDATE_INTERVAL = 0.2
 
+### Generation ###
+MODEL_BUNDLES = ["models/melody.mag", "models/bass.mag", "models/drums.mag"]
+
+CONCURRENT_GENERATION = False
+
+SEQUENCE_CACHE_DIR = "cache"
+SEQUENCE_CACHE_SIZE = 256 * 1024 * 1024  # in bytes
+
+PART_CACHE_SIZE = 16 * 1024 * 1024  # in bytes, for the generated parts of a running interaction
+CAPTURE_RETENTION_BARS = 8  # bars of captured input kept as primer for generation, None to keep all
+
+### Harmonization ###
+HARMONIZATION_MODE = "major"  # one of middleware.harmonizer.HARMONIZATION_MODES, can be changed at runtime
+
+### Instrumentation ###
+MIDI_INSTRUMENTATION = False  # records MIDI dispatch timings, reported when the composer stops
+MIDI_INSTRUMENTATION_FILE = "cache/midi_instrumentation.json"  # None to only write to the log
+
 ### Midi I/O ###
 HARMONIZER_INPUT_NAME = "vPort Harmonizer IN"
 HARMONIZER_OUTPUT_NAME = "vPort Harmonizer OUT"
 
 RECORDER_INPUT_NAME = "vPort Recorder IN"
 RECORDER_OUTPUT_NAME = "vPort Recorder OUT"
+
+RECORDING_FILE = "recording.mid"  # journaled while recording, see recover.py for interrupted sessions
+RECORDING_FLUSH_INTERVAL = 1.0  # in seconds
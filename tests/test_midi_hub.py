@@ -0,0 +1,213 @@
+"""
+Tests of the MIDI playback timing, run on a FakeClock() so that they do not depend on the speed of the machine.
+"""
+
+### System ###
+import time
+import threading
+from types import SimpleNamespace
+
+### Pytest ###
+import pytest
+
+### Mido ###
+from mido import ports  # pylint: disable-msg=no-name-in-module
+
+### Local ###
+from midi_interface.clock import FakeClock
+from midi_interface.instrumentation import Instrumentation
+from midi_interface.midi_hub import CallbackExecutor, Metronome, MidiHub, MidiPlayer, MidiSignal, PlaybackScheduler
+
+# Real seconds the scheduler thread is given to catch up with the fake clock after each step.
+_SETTLE_TIME = 0.005
+
+
+class RecordingPort():
+    """An output port that keeps the sent messages, and the times they were sent at if given a clock."""
+
+    def __init__(self, clock=None):
+        self.sent = []
+        self.send_times = []
+        self._clock = clock
+
+    def send(self, msg):
+        self.sent.append(msg)
+        if self._clock is not None:
+            self.send_times.append(self._clock.time())
+
+    def note_ons(self):
+        return [msg for msg in self.sent if msg.type == 'note_on']
+
+    def notes(self):
+        """Returns the sent note ons and offs as (type, pitch, time) tuples."""
+        return [(msg.type, msg.note, msg.time) for msg in self.sent if msg.type in ('note_on', 'note_off')]
+
+
+class DiscardingOutput(ports.BaseOutput):
+    """An output port that drops the sent messages."""
+
+    def _send(self, msg):
+        pass
+
+
+def make_sequence(*notes):
+    """Returns a stand-in for a NoteSequence with the given (pitch, start_time, end_time) notes."""
+    return SimpleNamespace(notes=[SimpleNamespace(pitch=pitch, velocity=100, start_time=start_time,
+                                                  end_time=end_time)
+                                  for pitch, start_time, end_time in notes])
+
+
+def advance(clock, until, step=0.05):
+    """Moves the clock forward to 'until' in steps, letting the scheduler send the messages due at each step."""
+    while clock.time() < until:
+        clock.advance_to(min(until, clock.time() + step))
+        time.sleep(_SETTLE_TIME)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(100.0)
+
+
+@pytest.fixture
+def scheduler(clock):
+    scheduler = PlaybackScheduler(clock)
+    yield scheduler
+    if scheduler.is_alive():
+        scheduler.stop()
+
+
+def test_metronome_ticks_from_its_start_time(clock, scheduler):
+    port = RecordingPort(clock)
+    metronome = Metronome(port, 120, 100.5, clock=clock, scheduler=scheduler)
+    metronome.start()
+
+    advance(clock, 102.6)
+    metronome.stop(clock.time(), block=False)
+    assert [msg.time for msg in port.note_ons()] == pytest.approx([100.5 + 0.5 * i for i in range(5)])
+    # The first tick of every bar is accented.
+    assert [msg.note for msg in port.note_ons()] == [44, 35, 35, 35, 44]
+    assert all(send_time >= msg.time for msg, send_time in zip(port.sent, port.send_times))
+
+
+def test_metronome_tempo_change_starts_at_the_next_bar(clock, scheduler):
+    port = RecordingPort()
+    metronome = Metronome(port, 120, 100.5, clock=clock, scheduler=scheduler)
+    metronome.start()
+
+    advance(clock, 101.2)
+    metronome.update(60, 100.5)
+    advance(clock, 105.6)
+    metronome.stop(clock.time(), block=False)
+    assert [msg.time for msg in port.note_ons()] == pytest.approx(
+        [100.5, 101.0, 101.5, 102.0, 102.5, 103.5, 104.5, 105.5])
+    assert [msg.note for msg in port.note_ons()][4:] == [44, 35, 35, 35]
+
+
+def test_metronome_starts_more_than_a_bar_ahead(clock, scheduler):
+    port = RecordingPort()
+    metronome = Metronome(port, 120, 103.0, clock=clock, scheduler=scheduler)
+    metronome.start()
+
+    advance(clock, 102.9)
+    assert not port.note_ons()
+
+    advance(clock, 105.0)
+    assert [msg.time for msg in port.note_ons()] == pytest.approx([103.0 + 0.5 * i for i in range(5)])
+    metronome.stop(clock.time(), block=False)
+
+
+def test_callbacks_with_the_same_key_run_in_order():
+    executor = CallbackExecutor(max_workers=4)
+    calls = []
+    running = []
+
+    def callback(value):
+        running.append(value)
+        assert len(running) == 1, "callbacks of one key overlapped"
+        time.sleep(0.001)
+        calls.append(value)
+        running.remove(value)
+
+    for value in range(20):
+        assert executor.submit(callback, value, key="registration")
+    executor.shutdown(wait=True)
+    assert calls == list(range(20))
+    assert executor.stats()['completed'] == 20
+
+
+def test_full_callback_queue_blocks_then_drops():
+    executor = CallbackExecutor(max_workers=1, max_queue_size=1, submit_timeout=0.01)
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait()
+
+    assert executor.submit(blocking)
+    started.wait()
+    assert executor.submit(blocking)
+    assert not executor.submit(blocking)
+    assert executor.stats()['dropped'] == 1
+    release.set()
+    executor.shutdown(wait=True)
+    assert executor.stats()['completed'] == 2
+
+
+def test_hub_lock_hold_excludes_waiting_for_a_signal(clock):
+    hub = MidiHub([], [DiscardingOutput()], None, clock=clock)
+    hub._instrumentation = Instrumentation()  # pylint: disable-msg=protected-access
+    signal = MidiSignal(type='note_on')
+    waiter = threading.Thread(target=hub.wait_for_event, args=(signal,))
+    waiter.start()
+    while hub._signals.get(signal) is None:  # pylint: disable-msg=protected-access
+        time.sleep(_SETTLE_TIME)
+    # The waiter registers the signal while holding the lock, which is only released once it waits.
+    with hub._lock:  # pylint: disable-msg=protected-access
+        pass
+
+    clock.advance(10.0)
+    hub.wake_signal_waiters(signal)
+    waiter.join()
+    hub.close()
+    hold = hub._instrumentation.to_dict()['hub_lock_hold']  # pylint: disable-msg=protected-access
+    assert hold['count'] >= 3
+    assert hold['max'] < 10.0
+
+
+def test_scheduler_sends_the_messages_of_all_players_in_time_order(clock, scheduler):
+    port = RecordingPort(clock)
+    first = MidiPlayer(port, make_sequence((60, 100.2, 100.6), (62, 101.0, 101.4)), channel=0, scheduler=scheduler)
+    second = MidiPlayer(port, make_sequence((64, 100.4, 100.8), (65, 100.9, 101.2)), channel=1, scheduler=scheduler)
+    first.start()
+    second.start()
+
+    advance(clock, 101.5)
+    first.join(1)
+    second.join(1)
+    assert not first.is_alive() and not second.is_alive()
+    assert [(msg.type, msg.note, msg.channel) for msg in port.sent] == [
+        ('note_on', 60, 0), ('note_on', 64, 1), ('note_off', 60, 0), ('note_off', 64, 1),
+        ('note_on', 65, 1), ('note_on', 62, 0), ('note_off', 65, 1), ('note_off', 62, 0)]
+    assert [msg.time for msg in port.sent] == sorted(msg.time for msg in port.sent)
+    assert all(send_time >= msg.time for msg, send_time in zip(port.sent, port.send_times))
+
+
+def test_splice_sequence_replaces_only_the_spliced_range(clock, scheduler):
+    port = RecordingPort()
+    player = MidiPlayer(port, make_sequence((60, 101.0, 101.5), (62, 102.0, 103.2), (64, 103.0, 103.4),
+                                            (67, 104.0, 104.5)),
+                        allow_updates=True, scheduler=scheduler)
+    player.start()
+
+    advance(clock, 102.2)
+    player.splice_sequence(make_sequence((65, 103.0, 103.3)), start_time=102.5, end_time=103.5)
+    advance(clock, 105.0)
+    player.stop(block=False)
+    assert port.notes() == pytest.approx([
+        ('note_on', 60, 101.0), ('note_off', 60, 101.5),
+        # The sounding note, which would have ended within the range, ends where the range starts.
+        ('note_on', 62, 102.0), ('note_off', 62, 102.5),
+        ('note_on', 65, 103.0), ('note_off', 65, 103.3),
+        ('note_on', 67, 104.0), ('note_off', 67, 104.5)])
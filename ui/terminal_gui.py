@@ -17,6 +17,7 @@ from mido import get_input_names, get_output_names  # pylint: disable-msg=no-nam
 ### Local ###
 from backend import ComposerManager
 from backend.song import load_song
+from middleware.harmonizer import HARMONIZATION_MODES
 
 ### Globals ###
 from settings import UPDATE_INTERVAL
@@ -120,6 +121,9 @@ class TerminalGUI(urwid.WidgetWrap):
         self.current_song_started = None
         self.current_song_duration = None
         self.animate_alarm = None
+        # The alarm that checks whether the models have been loaded, while the start is waiting for them.
+        self.start_alarm = None
+        self.status_text = None
         self.animate_progress = None
         self.animate_progress_wrap = None
         self.start_button = None
@@ -127,6 +131,7 @@ class TerminalGUI(urwid.WidgetWrap):
         self.song_buttons = []
         self.input_port_buttons = []
         self.output_port_buttons = []
+        self.harmonization_buttons = []
         self.composer = ComposerManager()
         self.composer.load_models()
         for song in list_songs():
@@ -139,14 +144,40 @@ class TerminalGUI(urwid.WidgetWrap):
             button.set_label("Start")
             self.started = False
             self.stop_refresh()
+            self.cancel_start()
             self.composer.stop()
             self.reset()
         else:
             button.set_label("Stop")
             self.started = True
-            self.refresh()
+            self.start_when_loaded()
+
+    def start_when_loaded(self, loop=None, user_data=None):
+        """Starts the song once the models have been loaded, checking again later while they are still loading."""
+        # pylint: disable-msg=unused-argument
+        self.start_alarm = None
+        if not self.composer.models_loaded():
+            self.status_text.set_text("Loading models...")
+            self.start_alarm = self.loop.set_alarm_in(UPDATE_INTERVAL, self.start_when_loaded)
+            return
+        try:
             self.current_song_duration = self.composer.start()
-            self.current_song_started = time()
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.exception("Failed to start")
+            self.status_text.set_text("Failed to start: {}".format(e))
+            self.start_button.set_label("Start")
+            self.started = False
+            self.composer.stop()
+            return
+        self.status_text.set_text("")
+        self.current_song_started = time()
+        self.refresh()
+
+    def cancel_start(self):
+        if self.start_alarm:
+            self.loop.remove_alarm(self.start_alarm)
+        self.start_alarm = None
+        self.status_text.set_text("")
 
     def on_reset_button(self, window):
         # pylint: disable-msg=unused-argument
@@ -184,6 +215,16 @@ class TerminalGUI(urwid.WidgetWrap):
                 radio_button.set_state(True, do_callback=False)
                 break
 
+    def on_harmonization_button(self, button, state):
+        if state:
+            self.composer.set_harmonization_mode(button.get_label())
+
+    def on_harmonization_change(self, mode):
+        for button in self.harmonization_buttons:
+            if button.get_label() == mode:
+                button.set_state(True, do_callback=False)
+                break
+
     def on_unicode_checkbox(self, window, state):
         # pylint: disable-msg=unused-argument
         logging.info("{} Unicode Graphics".format("Enabled" if state else "Disabled"))
@@ -211,6 +252,7 @@ class TerminalGUI(urwid.WidgetWrap):
                                           9, 2, 0, "center")
 
         self.animate_progress_wrap = urwid.WidgetWrap(self.animate_progress)
+        self.status_text = urwid.Text("", align="center")
 
         if urwid.get_encoding_mode() == "utf8":
             unicode_checkbox = urwid.CheckBox("Enable Unicode Graphics",
@@ -231,6 +273,12 @@ class TerminalGUI(urwid.WidgetWrap):
             radio_button = make_radio_button(group, port, self.on_output_port_button)
             self.output_port_buttons.append(radio_button)
 
+        self.harmonization_buttons = []
+        group = []
+        for mode in HARMONIZATION_MODES:
+            radio_button = make_radio_button(group, mode, self.on_harmonization_button)
+            self.harmonization_buttons.append(radio_button)
+
         ipb = [urwid.Text("No MIDI Input Ports available", align="center")]
         if self.input_port_buttons:
             ipb = [urwid.Text("MIDI Input Port", align="center")] + self.input_port_buttons
@@ -243,10 +291,13 @@ class TerminalGUI(urwid.WidgetWrap):
             self.song_buttons + \
             ([urwid.Divider()] + ipb if ipb else []) + \
             ([urwid.Divider()] + opb if opb else []) + \
+            [urwid.Divider(), urwid.Text("Harmonization", align="center")] + \
+            self.harmonization_buttons + \
             [urwid.Divider(),
              urwid.Text("Generation", align="center"),
              animate_controls,
              self.animate_progress_wrap,
+             self.status_text,
              urwid.Divider(),
              urwid.LineBox(unicode_checkbox),
              urwid.Divider(),
@@ -305,6 +356,8 @@ class TerminalGUI(urwid.WidgetWrap):
             self.composer.set_output_port(out_port[0])
             self.on_output_port_change(out_port[0])
 
+        self.on_harmonization_change(self.composer.harmonization_mode)
+
     def update_screen(self):
         self.keyboard_melody._invalidate()  # pylint: disable-msg=protected-access
         self.keyboard_bass._invalidate()  # pylint: disable-msg=protected-access